@@ -0,0 +1,201 @@
+import importlib
+import logging
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from citeproc import CiteProc
+from printing import PRINT_STEP
+from repository import Repository
+
+# the directory of the templates' static assets, which outputs refer to as ../static
+STATIC_DIRECTORY = 'static'
+
+
+def user_directory(user):
+    """
+    Builds a directory name for an eprints user (e.g. Eve=3AMartin_Paul=3A=3A)
+    :param user: the eprints user
+    :return: a string that is safe to use as a single path component
+    """
+    return re.sub(r'[^\w=.-]', '_', user)
+
+
+class UserConfig:
+    def __init__(self, config, user, workers=1, ports=None):
+        """
+        Initialise a view of a configuration for a single eprints user, whose data and outputs live in their own
+        directories (config.batch_data_directory/<user> and config.batch_output_directory/<user>)
+        Every other setting, including the citeproc servers and the response cache, is shared with the base
+        configuration
+        :param config: the base configuration
+        :param user: the eprints user
+        :param workers: the number of users being built at once, which share the citeproc request workers
+        :param ports: the citeproc ports that are ready (all of config.citeproc_ports if None)
+        """
+        self._config = config
+        self.user = user
+
+        data_directory = os.path.join(config.batch_data_directory, user_directory(user))
+        output_directory = os.path.join(config.batch_output_directory, user_directory(user))
+
+        self.eprints = dict(config.eprints, user=user)
+
+        self.storage = {name: os.path.join(data_directory, os.path.basename(path))
+                        for name, path in config.storage.items()}
+
+        # outputs (including printed PDFs) are moved into the user's directory, and shell steps that refer to them are
+        # pointed there too (see _link_static for the assets that the outputs refer to)
+        self.output_rules = {}
+
+        for rule, ruleset in config.output_rules.items():
+            moved = {path: os.path.join(output_directory, os.path.basename(path))
+                     for path in [ruleset[1]] + [step[len(PRINT_STEP):] for step in ruleset[2:]
+                                                 if step.startswith(PRINT_STEP)]}
+
+            steps = []
+
+            for step in ruleset[2:]:
+                if step.startswith(PRINT_STEP):
+                    steps.append(PRINT_STEP + moved[step[len(PRINT_STEP):]])
+                else:
+                    for path in sorted(moved, key=len, reverse=True):
+                        step = step.replace(path, moved[path])
+                    steps.append(step)
+
+            self.output_rules[rule] = [ruleset[0], moved[ruleset[1]]] + steps
+
+        self.citeproc_workers = max(1, config.citeproc_workers // workers)
+
+        if ports is not None:
+            self.citeproc_ports = list(ports)
+
+        self.directories = [data_directory, output_directory]
+
+    def __getattr__(self, name):
+        """
+        Falls back to the base configuration for every setting that is not specific to the user
+        :param name: the name of the setting
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        return getattr(self._config, name)
+
+
+def _fetch_user(config, logger, user, refresh):
+    """
+    Fetches and stores the eprints data for a single user
+    :param config: the base configuration
+    :param logger: a logger
+    :param user: the eprints user
+    :param refresh: whether to hit the remote endpoint even if there is an on-disk copy
+    :return: True if successful, otherwise False
+    """
+    user_config = UserConfig(config, user)
+
+    for directory in user_config.directories:
+        os.makedirs(directory, exist_ok=True)
+
+    logger.info("Fetching {0}".format(user))
+    return Repository(user_config, logger, refresh).fetch(list(config.eprints_db.keys()))
+
+
+def _link_static(config, logger):
+    """
+    Links the static assets into config.batch_output_directory, so that the relative asset paths of outputs in the
+    users' directories resolve, whether they are opened from disk or printed from the static file server
+    :param config: the configuration module
+    :param logger: a logger
+    :return: nothing
+    """
+    link = os.path.join(config.batch_output_directory, STATIC_DIRECTORY)
+
+    if os.path.lexists(link):
+        return
+
+    try:
+        os.makedirs(config.batch_output_directory, exist_ok=True)
+        os.symlink(os.path.relpath(STATIC_DIRECTORY, config.batch_output_directory), link, target_is_directory=True)
+    except EnvironmentError as exc:
+        logger.warning('Cannot link {0} to {1}, so outputs will not find their assets: {2}'.format(
+            link, STATIC_DIRECTORY, exc))
+
+
+def _build_user(config_name, logger_name, user, rules, workers, ports):
+    """
+    Builds the outputs for a single user in a worker process, against citeproc servers that are already running
+    :param config_name: the name of the configuration module
+    :param logger_name: the name of the logger
+    :param user: the eprints user
+    :param rules: a list of rule names
+    :param workers: the number of users being built at once
+    :param ports: the citeproc ports that are ready
+    :return: True if all rules were built, otherwise False
+    """
+    user_config = UserConfig(importlib.import_module(config_name), user, workers, ports)
+    logger = logging.getLogger(logger_name)
+
+    citeproc = CiteProc(Repository(user_config, logger, False), user_config, logger)
+
+    try:
+        logger.info("Building {0}".format(user))
+        return citeproc.build(rules)
+    finally:
+        # release the connections but leave the shared servers running
+        citeproc.close()
+
+
+def run_batch(config, logger, users, rules, refresh):
+    """
+    Builds CVs for many users: their exports are fetched concurrently, then each user is built in a process pool
+    against a single set of warm citeproc servers and a shared response cache
+    :param config: the configuration module
+    :param logger: a logger
+    :param users: a list of eprints users
+    :param rules: a list of rule names
+    :param refresh: whether to hit the remote endpoint even if there is an on-disk copy
+    :return: a dictionary of users to True if they were built, otherwise False
+    """
+    with ThreadPoolExecutor(max_workers=config.batch_fetch_workers) as executor:
+        fetched = dict(zip(users, executor.map(lambda user: _fetch_user(config, logger, user, refresh), users)))
+
+    for user in users:
+        if not fetched[user]:
+            logger.error("Cannot fetch {0}, skipping".format(user))
+
+    results = {user: False for user in users}
+    pending = [user for user in users if fetched[user]]
+
+    if len(pending) == 0:
+        return results
+
+    _link_static(config, logger)
+    citeproc = CiteProc(None, config, logger)
+
+    try:
+        if not citeproc.start(rules):
+            return results
+
+        workers = min(config.batch_workers, len(pending))
+
+        # the workers only use the ports that came up, rather than retrying those that did not
+        ports = citeproc.client.ports
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {user: executor.submit(_build_user, config.__name__, logger.name, user, rules, workers, ports)
+                       for user in pending}
+
+            for user, future in futures.items():
+                try:
+                    results[user] = future.result()
+                except Exception as exc:
+                    logger.error("Cannot build {0}: {1}".format(user, exc))
+
+                if not results[user]:
+                    logger.error("Failed to build {0}".format(user))
+    finally:
+        citeproc.shutdown()
+
+    logger.info("Built {0} of {1} CVs".format(sum(results.values()), len(users)))
+    return results
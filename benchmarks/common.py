@@ -0,0 +1,100 @@
+"""
+Helpers shared by the benchmarks: a factory for synthetic eprints items and a copy of the configuration that points
+its storage at a scratch directory.
+"""
+import os
+import sys
+import types
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, ROOT)
+
+import config
+
+TYPES = ['article'] * 5 + ['book'] * 2 + ['book_section'] * 2 + ['conference_item']
+FAMILY_NAMES = ['Eve', 'Smith', 'Jones', 'García', 'Nguyen', 'Müller', 'Okafor', 'Kowalski', 'Tanaka', 'Brown']
+GIVEN_NAMES = ['Martin Paul', 'Jane', 'A. B.', 'Lucía', 'Minh', 'Jürgen', 'Chidi', 'Anna', 'Yuki', 'Sam']
+WORDS = ['digital', 'humanities', 'open', 'access', 'novel', 'fiction', 'publishing', 'the', 'of', 'and', 'reading',
+         'literature', 'politics', 'scholarly', 'communication', 'economics', 'metafiction', 'archive', 'press']
+VENUES = ['Journal of Open Humanities Data', 'Textual Practice', 'C21 Literature', 'Critical Quarterly',
+          'Open Library of Humanities', 'martineve.com', 'Insights']
+
+
+def synthetic_item(rng, eprintid):
+    """
+    Builds an eprints item shaped like those in real exports
+    :param rng: a random.Random
+    :param eprintid: the eprint id
+    :return: an eprints item
+    """
+    item_type = rng.choice(TYPES)
+    year = rng.randint(1995, 2024)
+
+    item = {'eprintid': eprintid,
+            'uri': 'https://eprints.example.ac.uk/id/eprint/{0}'.format(eprintid),
+            'type': item_type,
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12))).capitalize(),
+            'date': '{0}-{1:02d}-{2:02d}'.format(year, rng.randint(1, 12), rng.randint(1, 28)),
+            'refereed': rng.choice(['TRUE', 'TRUE', 'FALSE']),
+            'creators': [{'name': {'family': rng.choice(FAMILY_NAMES), 'given': rng.choice(GIVEN_NAMES)},
+                          'id': 'author{0}@example.ac.uk'.format(rng.randint(1, 500))}
+                         for _ in range(rng.choice([1, 1, 1, 2, 3, 6]))],
+            'ispublished': 'pub'}
+
+    if rng.random() < 0.05:
+        item['title'] = '{0} {1}'.format(config.review_of, item['title'])
+
+    if item_type == 'book' and rng.random() < 0.3 or item_type == 'book_section':
+        item['editors'] = [{'name': {'family': rng.choice(FAMILY_NAMES), 'given': rng.choice(GIVEN_NAMES)}}
+                           for _ in range(rng.randint(1, 3))]
+
+    if item_type in ('book', 'book_section'):
+        item['publisher'] = rng.choice(['Bloomsbury', 'Cambridge University Press', 'MIT Press'])
+        item['place_of_pub'] = rng.choice(['London', 'Cambridge', 'Cambridge, MA'])
+
+    if item_type == 'book_section':
+        item['book_title'] = ' '.join(rng.choice(WORDS) for _ in range(6)).capitalize()
+
+    if item_type == 'article':
+        item['publication'] = rng.choice(VENUES)
+        item['volume'] = str(rng.randint(1, 60))
+        item['number'] = str(rng.randint(1, 4))
+
+    if item_type == 'conference_item':
+        item['event_title'] = 'Conference on {0}'.format(rng.choice(WORDS))
+        item['event_location'] = rng.choice(['Berlin', 'London', 'Toronto'])
+
+    if rng.random() < 0.7:
+        start = rng.randint(1, 300)
+        item['pagerange'] = '{0}-{1}'.format(start, start + rng.randint(5, 40))
+
+    if rng.random() < 0.6:
+        item['doi'] = '10.{0}/{1}'.format(rng.randint(1000, 9999), eprintid)
+
+    item['oa_status'] = rng.choice(['green', 'gold', 'none'])
+
+    if item['oa_status'] == 'gold':
+        item['official_url'] = 'https://doi.org/{0}'.format(item.get('doi', eprintid))
+
+    if item['oa_status'] != 'none' or rng.random() < 0.3:
+        item['documents'] = [{'uri': 'https://eprints.example.ac.uk/{0}/{1}/file.pdf'.format(eprintid, position),
+                              'format': 'application/pdf',
+                              'formatdesc': rng.choice(['Accepted version', 'Published version'])}
+                             for position in range(1, rng.choice([1, 1, 2, 3]) + 1)]
+
+    return item
+
+
+def benchmark_config(directory, **settings):
+    """
+    Copies the configuration, pointing its storage at a scratch directory
+    :param directory: the scratch directory
+    :param settings: any other settings to override
+    :return: a configuration module
+    """
+    benchmark = types.ModuleType('benchmark_config')
+    benchmark.__dict__.update({key: value for key, value in vars(config).items() if not key.startswith('__')})
+    benchmark.storage = {key: os.path.join(directory, os.path.basename(path)) for key, path in config.storage.items()}
+    benchmark.__dict__.update(settings)
+
+    return benchmark
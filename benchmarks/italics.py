@@ -0,0 +1,67 @@
+"""
+Benchmark title italicisation as the list of titles grows.
+
+Usage:
+  python3 benchmarks/italics.py
+
+Compares the per-item cost of the compiled TitleMatcher with applying one regex per title in turn.
+"""
+import os
+import random
+import re
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import config
+from italics import TitleMatcher
+
+SIZES = [60, 600, 6000]
+ITEMS = 200
+
+
+def random_title(rng):
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(2, 9))).capitalize()
+                    for _ in range(rng.randint(1, 6)))
+
+
+def main():
+    rng = random.Random(1)
+
+    # realistic item titles, some of which mention configured titles
+    items = []
+    for _ in range(ITEMS):
+        title = random_title(rng)
+        if rng.random() < 0.3:
+            title = 'Review of {0} and {1}'.format(rng.choice(config.titles_to_italicize), title)
+        items.append(title)
+
+    print('{0:>8} {1:>16} {2:>16}'.format('titles', 'regex us/item', 'matcher us/item'))
+
+    for size in SIZES:
+        titles = list(config.titles_to_italicize)
+        while len(titles) < size:
+            titles.append(random_title(rng))
+
+        regexen = [re.compile(r'(\W|^)({0})(\W|$)'.format(re.escape(title))) for title in titles]
+        matcher = TitleMatcher(titles)
+
+        def apply_regexen():
+            for item in items:
+                for regex in regexen:
+                    item = regex.sub(r'\1<i>\2</i>\3', item)
+
+        def apply_matcher():
+            for item in items:
+                matcher.italicize(item)
+
+        regex_time = min(timeit.repeat(apply_regexen, number=1, repeat=3)) / ITEMS * 1e6
+        matcher_time = min(timeit.repeat(apply_matcher, number=1, repeat=3)) / ITEMS * 1e6
+
+        print('{0:>8} {1:>16.1f} {2:>16.1f}'.format(size, regex_time, matcher_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Benchmark the fetch and build pipeline against synthetic eprints exports.
+
+Usage:
+  benchmarks/pipeline.py [options]
+
+Options:
+  --sizes=<sizes>       Comma-separated export sizes [default: 100,1000,10000,100000].
+  --latency=<ms>        The latency of each stub citeproc request in milliseconds [default: 5].
+  --ports=<count>       The number of stub citeproc servers [default: 4].
+  --output=<file>       The results file [default: benchmark-results.json].
+  --thresholds=<file>   The thresholds to compare against [default: benchmarks/thresholds.json].
+
+Each size is written as a synthetic export (with realistic creators, editors, documents and oa_status) that is
+served over HTTP to Repository.fetch, then built with CiteProc.build against stub citeproc servers: once with a cold
+response cache, once with a warm one, and once more as a no-op incremental build. Each stage runs in its own process so
+that its peak memory can be measured. The results are written as JSON and the command exits with status 1 if any
+stage misses its thresholds.
+"""
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from docopt import docopt
+
+from common import ROOT, benchmark_config, synthetic_item
+
+import config
+from citeproc import CiteProc
+from repository import Repository
+
+RULE = 'html'
+
+
+def write_export(path, size):
+    """
+    Writes a synthetic export
+    :param path: the destination
+    :param size: the number of items
+    :return: nothing
+    """
+    rng = random.Random(size)
+
+    with open(path, 'w') as out_file:
+        json.dump([synthetic_item(rng, eprintid) for eprintid in range(1, size + 1)], out_file)
+
+
+def _serve(handler):
+    """
+    Serves a request handler on an ephemeral port in a background thread
+    :param handler: a BaseHTTPRequestHandler subclass
+    :return: the HTTP server
+    """
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def serve_export(path):
+    """
+    Serves an export file at any URL
+    :param path: the export file
+    :return: the HTTP server
+    """
+    class ExportHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(os.path.getsize(path)))
+            self.end_headers()
+
+            with open(path, 'rb') as in_file:
+                shutil.copyfileobj(in_file, self.wfile)
+
+    return _serve(ExportHandler)
+
+
+def serve_citeproc(latency):
+    """
+    Serves a stub citeproc-js-server that answers in the same shape as the real one after a fixed latency
+    :param latency: the latency of each request in seconds
+    :return: the HTTP server
+    """
+    class CiteprocHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # send the headers and body in one segment, as otherwise Nagle's algorithm and delayed ACKs add ~40ms to
+        # every keep-alive request
+        wbufsize = 65536
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            time.sleep(latency)
+
+            entry_ids = []
+            entries = []
+
+            for identifier, item in payload['items'].items():
+                names = item.get('author') or item.get('editor') or []
+                entry_ids.append([identifier])
+                entries.append('<div class="csl-entry">{0} ({1}). <i>{2}</i>. {3}.</div>'.format(
+                    ', '.join(name.get('family', '') for name in names), item['issued']['date-parts'][0][0],
+                    item['title'], item.get('container-title', item.get('publisher', ''))))
+
+            body = json.dumps({'bibliography': [{'entry_ids': entry_ids}, entries]}).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return _serve(CiteprocHandler)
+
+
+def stage_config(directory, export_port, citeproc_ports, incremental):
+    """
+    Copies the configuration, pointing its storage, cache and output at a scratch directory and its servers at stubs
+    :param directory: the scratch directory
+    :param export_port: the port of the stub export
+    :param citeproc_ports: the ports of the stub citeproc servers
+    :param incremental: whether builds keep a manifest (config.incremental_builds)
+    :return: a configuration module
+    """
+    return benchmark_config(
+        directory,
+        eprints={'repo': 'http://127.0.0.1:{0}'.format(export_port), 'user': 'benchmark'},
+        citeproc_cache_directory=os.path.join(directory, 'cache'),
+        citeproc_cache_size=10000000,
+        citeproc_ports=[str(port) for port in citeproc_ports],
+        citeproc_engine=dict(config.citeproc_engine, **{RULE: 'http'}),
+        sections_directory=os.path.join(ROOT, config.sections_directory),
+        output_rules={RULE: [os.path.join(ROOT, config.output_rules[RULE][0]), os.path.join(directory, 'output.html')]},
+        incremental_builds=incremental,
+        parallel_rules=False)
+
+
+def _run_stage(stage, directory, export_port, citeproc_ports, queue):
+    """
+    Runs one stage in a child process and reports its wall time and peak memory
+    :param stage: the stage ('fetch', 'build_cold', 'build_warm' or 'build_noop')
+    :param directory: the scratch directory
+    :param export_port: the port of the stub export
+    :param citeproc_ports: the ports of the stub citeproc servers
+    :param queue: the queue on which to put a (succeeded, seconds, peak MB) tuple
+    :return: nothing
+    """
+    logger = logging.getLogger('benchmark')
+    incremental = stage == 'build_noop'
+    benchmark = stage_config(directory, export_port, citeproc_ports, incremental)
+
+    started = time.perf_counter()
+
+    if stage == 'fetch':
+        succeeded = Repository(benchmark, logger, True).fetch(list(benchmark.eprints_db.keys()))
+    else:
+        citeproc = CiteProc(Repository(benchmark, logger, False), benchmark, logger)
+        succeeded = citeproc.build([RULE])
+        citeproc.close()
+
+    seconds = time.perf_counter() - started
+    queue.put((succeeded, seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def run_stage(stage, directory, export_port, citeproc_ports):
+    """
+    Runs one stage in a fresh child process, so that its peak memory is its own
+    :param stage: the stage ('fetch', 'build_cold', 'build_warm' or 'build_noop')
+    :param directory: the scratch directory
+    :param export_port: the port of the stub export
+    :param citeproc_ports: the ports of the stub citeproc servers
+    :return: a (succeeded, seconds, peak MB) tuple
+    """
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_run_stage, args=(stage, directory, export_port, citeproc_ports, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def check(result, thresholds):
+    """
+    Compares a result with the thresholds for its stage
+    :param result: a result
+    :param thresholds: a dictionary of stage names to thresholds
+    :return: a list of descriptions of the thresholds that were missed
+    """
+    failures = []
+    limits = thresholds.get(result['stage'], {})
+
+    if not result['succeeded']:
+        failures.append('{0} at {1} items failed'.format(result['stage'], result['items']))
+
+    if 'min_items_per_second' in limits and result['items_per_second'] < limits['min_items_per_second']:
+        failures.append('{0} at {1} items: {2:.0f} items/s is below {3}'.format(
+            result['stage'], result['items'], result['items_per_second'], limits['min_items_per_second']))
+
+    if 'max_seconds' in limits and result['seconds'] > limits['max_seconds']:
+        failures.append('{0} at {1} items: {2:.3f}s is above {3}s'.format(
+            result['stage'], result['items'], result['seconds'], limits['max_seconds']))
+
+    if 'max_rss_mb_per_1k_items' in limits:
+        limit = limits.get('base_rss_mb', 0) + limits['max_rss_mb_per_1k_items'] * result['items'] / 1000.0
+
+        if result['max_rss_mb'] > limit:
+            failures.append('{0} at {1} items: {2:.0f} MB is above {3:.0f} MB'.format(
+                result['stage'], result['items'], result['max_rss_mb'], limit))
+
+    return failures
+
+
+def main():
+    arguments = docopt(__doc__)
+    sizes = [int(size) for size in arguments['--sizes'].split(',')]
+    latency = float(arguments['--latency']) / 1000.0
+
+    logging.basicConfig(level=logging.WARNING)
+
+    try:
+        with open(arguments['--thresholds'], 'r') as thresholds_file:
+            thresholds = json.load(thresholds_file)
+    except (EnvironmentError, ValueError):
+        thresholds = {}
+
+    citeproc_servers = [serve_citeproc(latency) for _ in range(int(arguments['--ports']))]
+    citeproc_ports = [server.server_address[1] for server in citeproc_servers]
+
+    results = []
+    failures = []
+
+    print('{0:>8} {1:>12} {2:>10} {3:>12} {4:>10}'.format('items', 'stage', 'seconds', 'items/s', 'peak MB'))
+
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+
+        try:
+            export_file = os.path.join(directory, 'export.json')
+            write_export(export_file, size)
+            export_server = serve_export(export_file)
+
+            for stage in ['fetch', 'build_cold', 'build_warm', 'build_noop']:
+                if stage == 'build_noop':
+                    # the first incremental build records the manifest, the second is the no-op being measured
+                    run_stage(stage, directory, export_server.server_address[1], citeproc_ports)
+
+                succeeded, seconds, max_rss = run_stage(stage, directory, export_server.server_address[1],
+                                                        citeproc_ports)
+
+                result = {'stage': stage,
+                          'items': size,
+                          'succeeded': bool(succeeded),
+                          'seconds': seconds,
+                          'items_per_second': size / seconds if seconds > 0 else 0,
+                          'max_rss_mb': max_rss}
+
+                results.append(result)
+                failures.extend(check(result, thresholds))
+
+                print('{0:>8} {1:>12} {2:>10.3f} {3:>12.0f} {4:>10.1f}'.format(
+                    size, stage, seconds, result['items_per_second'], max_rss))
+
+            export_server.shutdown()
+            export_server.server_close()
+        finally:
+            shutil.rmtree(directory)
+
+    with open(arguments['--output'], 'w') as results_file:
+        json.dump({'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'latency_ms': latency * 1000,
+                   'citeproc_ports': len(citeproc_ports),
+                   'results': results,
+                   'thresholds': thresholds,
+                   'failures': failures}, results_file, indent=2)
+
+    for failure in failures:
+        print('FAIL: {0}'.format(failure))
+
+    sys.exit(1 if len(failures) > 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
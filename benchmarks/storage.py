@@ -0,0 +1,60 @@
+"""
+Benchmark loading sections from each storage backend as the export grows.
+
+Usage:
+  python3 benchmarks/storage.py
+
+Writes synthetic exports of 1k, 10k and 100k items to each backend in a temporary directory, then times reading
+every section from a fresh Repository (i.e. a cold in-memory cache). "binary-zlib" is the binary store with
+config.storage_compression = 1.
+"""
+import logging
+import os
+import random
+import shutil
+import tempfile
+import timeit
+
+from common import benchmark_config, synthetic_item
+
+from repository import Repository
+
+SIZES = [1000, 10000, 100000]
+BACKENDS = ['jsonl', 'sqlite', 'binary', 'binary-zlib']
+
+
+def main():
+    logger = logging.getLogger('benchmark')
+    rng = random.Random(1)
+
+    print('{0:>8} {1:>12} {2:>12} {3:>12} {4:>12}'.format('items', 'backend', 'write s', 'load s', 'bytes'))
+
+    for size in SIZES:
+        items = [synthetic_item(rng, eprintid) for eprintid in range(size)]
+
+        for backend in BACKENDS:
+            directory = tempfile.mkdtemp()
+
+            try:
+                benchmark = benchmark_config(directory, storage_backend=backend.split('-')[0],
+                                             storage_compression=1 if backend.endswith('zlib') else 0)
+
+                repo = Repository(benchmark, logger, False)
+                write_time = timeit.timeit(lambda: repo._write_sections_to_disk(iter(items)), number=1)
+
+                def load():
+                    fresh = Repository(benchmark, logger, False)
+                    for name in benchmark.eprints_db:
+                        fresh._load_section(name)
+
+                load_time = min(timeit.repeat(load, number=1, repeat=3))
+                size_on_disk = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+                print('{0:>8} {1:>12} {2:>12.3f} {3:>12.3f} {4:>12}'.format(size, backend, write_time, load_time,
+                                                                           size_on_disk))
+            finally:
+                shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import tempfile
+
+
+class ResponseCache:
+    def __init__(self, directory, max_entries, logger):
+        """
+        Initialise a persistent, content-addressed cache of citeproc responses
+        :param directory: the directory in which to store cached responses
+        :param max_entries: the maximum number of responses to keep on disk (0 disables the cache)
+        :param logger: a logger
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.logger = logger
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.directory is not None and self.max_entries > 0
+
+    @staticmethod
+    def key(engine, style, payload):
+        """
+        Builds a cache key for a CSL-JSON payload rendered in a given style
+        :param engine: the name of the rendering engine
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :return: a hex digest string
+        """
+        # the item identifiers are positional ('{counter}-{date}') so we leave them out of the key
+        # otherwise adding a single publication would invalidate every item that follows it
+        items = [{k: v for k, v in item.items() if k != 'id'} for item in payload['items'].values()]
+
+        digest = hashlib.sha256()
+        digest.update(engine.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(style.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(json.dumps(items, sort_keys=True).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[0:2], key + '.json')
+
+    def get(self, key):
+        """
+        Fetches a response from the cache
+        :param key: the cache key
+        :return: the cached response or None if there is no entry
+        """
+        if not self.enabled:
+            return None
+
+        path = self._path(key)
+
+        try:
+            with open(path, 'r') as cache_file:
+                response = json.load(cache_file)
+        except (EnvironmentError, ValueError):
+            self.misses += 1
+            return None
+
+        # touch the entry so that eviction is least-recently-used
+        try:
+            os.utime(path)
+        except EnvironmentError:
+            pass
+
+        self.hits += 1
+        return response
+
+    def put(self, key, response):
+        """
+        Stores a response in the cache
+        :param key: the cache key
+        :param response: the JSON response from citeproc
+        :return: nothing
+        """
+        if not self.enabled:
+            return
+
+        path = self._path(key)
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # write to a temporary file and rename so that readers never see a partial entry
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(handle, 'w') as cache_file:
+                json.dump(response, cache_file)
+            os.replace(temp_path, path)
+        except EnvironmentError:
+            self.logger.warning('Cannot write citeproc response to cache {0}'.format(path))
+            return
+
+        self._writes += 1
+
+    def evict(self):
+        """
+        Removes the least-recently-used entries until the cache is within its size bound
+        :return: the number of entries removed
+        """
+        if not self.enabled or self._writes == 0:
+            return 0
+
+        entries = []
+
+        for root, dirs, files in os.walk(self.directory):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    entries.append((os.stat(path).st_mtime, path))
+                except EnvironmentError:
+                    pass
+
+        removed = 0
+
+        if len(entries) > self.max_entries:
+            entries.sort()
+            for mtime, path in entries[0:len(entries) - self.max_entries]:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except EnvironmentError:
+                    pass
+
+            self.logger.debug('Evicted {0} entries from the citeproc cache'.format(removed))
+
+        self._writes = 0
+        return removed
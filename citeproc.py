@@ -1,146 +1,539 @@
 import os
-import re
-import requests
 import subprocess
-from datetime import datetime
-from multiprocessing.pool import Pool
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+from cache import ResponseCache
+from client import CiteProcClient
+from engines import PythonEngine
+from externals import EXTERNAL_PREFIX, ExternalSections
+from italics import TitleMatcher
+from manifest import BuildManifest, digest_text, digest_value
+from metrics import Metrics
+from printing import PRINT_STEP, print_pdf
+from sections import SectionRegistry
+from template import TemplateCache
+
+# the settings that affect how a rule renders its eprints sections (where a setting is keyed by rule, only the rule's
+# own value is used)
+RENDER_SETTINGS = ['section_headings', 'section_template', 'header_template', 'citeproc_item_templates',
+                   'citeproc_item_templates_new_date', 'citeproc_type_mapper', 'citeproc_style', 'citeproc_batch_style',
+                   'citeproc_engine', 'creators_item_name', 'creator_field_top_level', 'creator_field_given_name',
+                   'creator_field_last_name', 'editors_item_name', 'editor_field_top_level',
+                   'editor_field_given_name', 'editor_field_last_name', 'gold_oa_direct_link', 'email', 'oa_status',
+                   'non_oa_status', 'exclude_venues', 'italicize_titles', 'titles_to_italicize']
 
 
 class CiteProc:
-    def __init__(self, repo, config, logger):
+    def __init__(self, repo, config, logger, metrics=None):
         self.config = config
         self.logger = logger
         self.repo = repo
 
-        self.cached_italic_regexen = []
+        # the time spent in each stage of the run, shared with the client
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # compile the titles to italicize into a single matcher up front as rules may be built concurrently
+        self.title_matcher = TitleMatcher(config.titles_to_italicize)
+
+        # the persistent cache of citeproc responses
+        self.cache = ResponseCache(config.citeproc_cache_directory, config.citeproc_cache_size, logger)
+
+        # a single pooled client for all requests to the citeproc server(s)
+        self.client = CiteProcClient(config, logger, self.metrics)
+
+        # compiled templates, reparsed only when they change on disk
+        self.templates = TemplateCache()
+
+        # the static sections, read once and refreshed only when they change on disk
+        self.sections = SectionRegistry(config.sections_directory, logger)
+
+        # the commands of external sections, run concurrently and memoised across rules and runs
+        self.externals = ExternalSections(config, logger)
+
+        # the content hashes of the last build, so that unchanged sections and outputs are not rebuilt
+        self.manifest = BuildManifest(config.storage['manifest'], logger) if config.incremental_builds else None
+
+        # the hashes of inputs are also used to key rendered documents (see server.py), with or without a manifest
+        self._digests = self.manifest if self.manifest is not None else BuildManifest(None, logger)
+
+        # when started lazily, the citeproc-js server(s) are only launched once a request needs them
+        self._lazy_rules = None
+        self._start_lock = threading.Lock()
+        # whether a deferred start has failed during this build, so that later sections fail without retrying it
+        self._start_failed = False
+
+        # the rules whose output is missing the entries of failed citeproc requests in this build (a rule's sections are
+        # rendered by a single thread, but rules may run in parallel)
+        self._incomplete_rules = set()
+        self._incomplete_lock = threading.Lock()
+
+        # the rendering engines that rules can select in config.citeproc_engine
+        self.engines = {'http': self.client,
+                        'python': PythonEngine(config, logger)}
 
         # start the citeproc server
         self.init_commands = []
+        self.shutdown_commands = []
 
         for port in config.citeproc_ports:
             self.init_commands.append('screen -S serve_npm{0} -d -m bash -c "node lib/citeServer.js --port {0} > log.txt"'.format(port))
+            self.shutdown_commands.append('screen -d -m  bash -c "screen -S serve_npm{0} -X quit"'.format(port))
 
-    def start(self):
+    def start(self, rules=None, lazy=False):
         """
-        Start the NPM citeproc-js server
-        :return: Nothing
+        Start the NPM citeproc-js server(s) and wait until they are ready
+        :param rules: the rules that will be built (if given, the servers are only started when a rule needs them)
+        :param lazy: whether to defer starting the servers until the first request that is not served from a cache
+        :return: True if at least one server is ready (or none are needed, or they are deferred), otherwise False
         """
+        if rules is not None and all(self.config.citeproc_engine.get(rule) != 'http' for rule in rules):
+            self.logger.debug('No rule uses the http engine, not starting citeproc-js-server(s)')
+            return True
+
+        if lazy:
+            self.logger.debug('Deferring the start of citeproc-js-server(s) until they are needed')
+            self._lazy_rules = rules
+            return True
+
         for shell_script in self.init_commands:
             subprocess.call(shell_script, shell=True, cwd=self.config.citeproc_js_server_directory)
-        time.sleep(self.config.citeproc_delay)
-        self.logger.info('Started citeproc-js-server(s)')
+
+        # warm up every style that the rules might use
+        styles = set(self.config.citeproc_style.values())
+        styles.update(style for style in self.config.citeproc_batch_style.values() if style)
+
+        ready_ports = self.client.wait_until_ready(sorted(styles))
+
+        if len(ready_ports) == 0:
+            self.logger.error('No citeproc-js-server became ready')
+            return False
+
+        self.logger.info('Started citeproc-js-server(s) on {0} port(s)'.format(len(ready_ports)))
+        return True
+
+    def _ensure_started(self):
+        """
+        Start the citeproc-js server(s) if their start was deferred and has not yet happened
+        :return: True if the servers are ready (or were never deferred), otherwise False
+        """
+        with self._start_lock:
+            if self._lazy_rules is None:
+                return True
+
+            if self._start_failed:
+                return False
+
+            rules = self._lazy_rules
+
+            if not self.start(rules):
+                self._start_failed = True
+                return False
+
+            self._lazy_rules = None
+            return True
 
     def shutdown(self):
         """
         Shutdown the NPM citeproc-js server
         :return: Nothing
         """
+        self.close()
+        self._stop_servers()
 
-        shutdown_commands = []
-
-        for port in self.config.citeproc_ports:
-            shutdown_commands.append('screen -d -m  bash -c "screen -S serve_npm{0} -X quit"'.format(port))
+        self.logger.info('Shutdown citeproc-js-server')
 
-        for shell_script in shutdown_commands:
+    def _stop_servers(self):
+        """
+        Stop the NPM citeproc-js server(s)
+        :return: Nothing
+        """
+        for shell_script in self.shutdown_commands:
             subprocess.call(shell_script, shell=True)
 
-        self.logger.info('Shutdown citeproc-js-server')
+    def close(self):
+        """
+        Release the rendering engines' connections and workers without stopping the citeproc-js server(s)
+        :return: Nothing
+        """
+        for engine in self.engines.values():
+            engine.close()
+
+        self.externals.close()
+
+    def build(self, rules, force=False):
+        """
+        Build the output documents for a set of rules, concurrently if configured
+        :param rules: a list of rule names
+        :param force: whether to rebuild everything, ignoring the build manifest
+        :return: True if all rules were built, otherwise False
+        """
+        # a deferred start that failed in an earlier build (e.g. in watch mode) is tried once more, after stopping
+        # whatever the failed attempt left running
+        with self._start_lock:
+            if self._start_failed:
+                self._stop_servers()
+                self._start_failed = False
 
-    def build(self, rules):
         for rule in rules:
-            # load the ruleset
             if rule not in self.config.output_rules:
                 self.logger.error("Ruleset {0} is not defined".format(rule))
                 return False
 
-            self.logger.debug("Loading ruleset for {0}".format(rule))
-            ruleset = self.config.output_rules[rule]
+            if self.config.citeproc_engine[rule] not in self.engines:
+                self.logger.error("Rendering engine {0} for ruleset {1} is not defined".format(
+                    self.config.citeproc_engine[rule], rule))
+                return False
 
-            template_file = ruleset[0]
-            output_file = ruleset[1]
+        # check that every static section exists before anything is rendered
+        templates = []
 
-            template = self._load_template(template_file)
+        for rule in rules:
+            template = self._load_template(self.config.output_rules[rule][0])
 
-            if not template:
+            if template is None:
                 return False
 
-            template = self._substitute_template(template, rule)
+            templates.append(template)
 
-            if not template:
+            missing = self.sections.missing([match for match in template.placeholders
+                                             if match not in self.config.section_headings[rule] and
+                                             not match.startswith(EXTERNAL_PREFIX)])
+
+            if len(missing) > 0:
+                self.logger.error("Template {0} refers to missing section(s) {1} in {2}".format(
+                    self.config.output_rules[rule][0], ', '.join(missing), self.config.sections_directory))
                 return False
 
-            try:
-                # write the output to the output file
-                with open(output_file, "w") as out_file:
-                    out_file.write(template)
-            except EnvironmentError:
-                self.logger.error('Cannot write output to {0}'.format(output_file))
-                # try to delete the file
-                os.remove(output_file)
+            # e.g. after config.storage_backend has changed, the new store does not exist until the next fetch
+            missing = [match for match in template.placeholders
+                       if match in self.config.section_headings[rule] and not self.repo.store.has_sections([match])]
+
+            if len(missing) > 0:
+                self._log_missing_data(missing)
                 return False
 
-            # run any remaining shell scripts
-            if len(ruleset) > 2:
-                counter = 0
-                for shell_script in ruleset:
-                    if counter < 2:
-                        counter += 1
-                    else:
-                        self.logger.debug("Calling shell script {0}".format(shell_script))
-                        subprocess.call(shell_script, shell=True)
-        return True
+        # start every external command that the rules need up front (even those with fresh output, if forced), so that
+        # slow commands run side by side
+        for template in templates:
+            self.externals.prefetch(template.placeholders, force)
+
+        if self.config.parallel_rules and len(rules) > 1:
+            # rules share the rendering engines, so identical requests from different rules are only sent once
+            with ThreadPoolExecutor(max_workers=len(rules)) as executor:
+                results = list(executor.map(lambda rule: self._measure_rule(rule, force), rules))
+        else:
+            results = []
+            for rule in rules:
+                results.append(self._measure_rule(rule, force))
+                if not results[-1]:
+                    break
+
+        # forget the shared responses of this run and keep the response cache within its size bound
+        for engine in self.engines.values():
+            engine.clear()
+        self.externals.clear()
+        self.cache.evict()
+
+        if self.manifest is not None:
+            self.manifest.save()
+
+        for rule in rules:
+            self._record_hit_ratio('citeproc_cache', rule)
+            self._record_hit_ratio('section_cache', rule)
+
+        return all(results)
+
+    def _measure_rule(self, rule, force=False):
+        """
+        Build the output document for a single rule, recording how long it took and whether it succeeded
+        :param rule: the rule name
+        :param force: whether to rebuild everything, ignoring the build manifest
+        :return: True if successful, otherwise False
+        """
+        started = time.monotonic()
+        succeeded = self._build_rule(rule, force)
+
+        self.metrics.set_value('rule_duration_seconds', time.monotonic() - started, {'rule': rule})
+        self.metrics.set_value('rule_succeeded', int(succeeded), {'rule': rule})
+
+        return succeeded
+
+    def _record_hit_ratio(self, cache, rule):
+        """
+        Records the hit ratio of a cache for a rule from its hit and miss counters
+        :param cache: the name of the cache (e.g. 'citeproc_cache')
+        :param rule: the rule name
+        :return: nothing
+        """
+        labels = {'rule': rule}
+        hits = self.metrics.counter(cache + '_hits_total', labels)
+        misses = self.metrics.counter(cache + '_misses_total', labels)
+
+        if hits + misses > 0:
+            self.metrics.set_value(cache + '_hit_ratio', hits / (hits + misses), labels)
+
+    def _build_rule(self, rule, force=False):
+        """
+        Build the output document for a single rule, skipping the sections and output that are unchanged since the
+        last build
+        :param rule: the rule name
+        :param force: whether to rebuild everything, ignoring the build manifest
+        :return: True if successful, otherwise False
+        """
+        # load the ruleset
+        self.logger.debug("Loading ruleset for {0}".format(rule))
+        ruleset = self.config.output_rules[rule]
+
+        template_file = ruleset[0]
+        output_file = ruleset[1]
+
+        with self._incomplete_lock:
+            self._incomplete_rules.discard(rule)
+
+        # the time taken by each stage of the build, in order
+        timings = []
+        stage_started = time.monotonic()
+
+        template = self._load_template(template_file)
+
+        if template is None:
+            return False
+
+        inputs = None
+        previous = {}
+
+        if self.manifest is not None:
+            inputs = self._rule_inputs(template, template_file, rule)
+
+            if not force:
+                previous = self.manifest.get(rule)
+
+            # external sections are not tracked, so a rule that has them is always rebuilt
+            if previous.get('inputs') == inputs and None not in inputs.values() and \
+                    self.manifest.file_digest(output_file) == previous.get('output') and \
+                    all(os.path.isfile(step[len(PRINT_STEP):]) for step in ruleset[2:] if step.startswith(PRINT_STEP)):
+                self.logger.info("{0} is up to date".format(output_file))
+                return True
+
+        timings.append(('inputs', time.monotonic() - stage_started))
+        stage_started = time.monotonic()
+
+        sections = {}
+
+        with self.metrics.timer('template substitution'):
+            template = self._substitute_template(template, rule, inputs, previous.get('sections', {}), sections)
+
+        if not template:
+            return False
+
+        timings.append(('render', time.monotonic() - stage_started))
+        output_digest = digest_text(template)
+
+        with self._incomplete_lock:
+            incomplete = rule in self._incomplete_rules
+
+        if incomplete:
+            self.logger.warning("{0} is missing the entries that could not be rendered".format(output_file))
+
+        if self.manifest is not None and not incomplete and \
+                self.manifest.file_digest(output_file) == output_digest and \
+                all(os.path.isfile(step[len(PRINT_STEP):]) for step in ruleset[2:] if step.startswith(PRINT_STEP)):
+            # the output has not changed, so leave it (and anything built from it) alone
+            self.logger.info("{0} is unchanged".format(output_file))
+            self.manifest.set(rule, {'inputs': inputs, 'sections': sections, 'output': output_digest})
+            return True
+
+        stage_started = time.monotonic()
+
+        try:
+            # write the output to the output file
+            with open(output_file, "w") as out_file:
+                out_file.write(template)
+        except EnvironmentError:
+            self.logger.error('Cannot write output to {0}'.format(output_file))
+            # try to delete the file
+            os.remove(output_file)
+            return False
+
+        timings.append(('write', time.monotonic() - stage_started))
+        self.metrics.add_time('output writes', timings[-1][1])
+        succeeded = True
+
+        # run any remaining steps
+        for step in ruleset[2:]:
+            stage_started = time.monotonic()
+
+            if step.startswith(PRINT_STEP):
+                printed = print_pdf(self.config, self.logger, output_file, step[len(PRINT_STEP):])
+                self.metrics.add_time('pdf printing', time.monotonic() - stage_started)
+
+                if not printed:
+                    succeeded = False
+                    break
+
+                timings.append(('print', time.monotonic() - stage_started))
+            else:
+                self.logger.debug("Calling shell script {0}".format(step))
+                subprocess.call(step, shell=True)
+                self.metrics.add_time('shell steps', time.monotonic() - stage_started)
+                timings.append((step.split(' ')[0], time.monotonic() - stage_started))
+
+        self.logger.info("Built {0} ({1})".format(output_file, ', '.join('{0} {1:.2f}s'.format(stage, seconds)
+                                                                         for stage, seconds in timings)))
+
+        # a failed step, or a failed citeproc request, is retried by the next build
+        if self.manifest is not None and succeeded and not incomplete:
+            self.manifest.set(rule, {'inputs': inputs, 'sections': sections, 'output': output_digest})
+
+        return succeeded
+
+    def input_digest(self, rule):
+        """
+        Hashes all of the inputs of a rule
+        :param rule: the rule name
+        :return: a hex digest string, or None if the template cannot be loaded
+        """
+        template_file = self.config.output_rules[rule][0]
+        template = self._load_template(template_file)
+
+        if template is None:
+            return None
+
+        inputs = self._rule_inputs(template, template_file, rule)
+
+        # the manifest always rebuilds external sections, but a rendered document only goes stale when their output
+        # changes
+        for match in template.placeholders:
+            if match.startswith(EXTERNAL_PREFIX):
+                inputs[match] = self._digests.file_digest(self.externals.parse(match)[2])
+
+        return digest_value(inputs)
+
+    def _rule_inputs(self, template, template_file, rule):
+        """
+        Hashes the inputs of each placeholder in a rule's template
+        :param template: the CompiledTemplate
+        :param template_file: the template file
+        :param rule: the rule
+        :return: a dictionary of placeholder names (and the template itself) to hashes, where None means that the
+        input cannot be tracked and must always be rebuilt
+        """
+        inputs = {'template:' + template_file: self._digests.file_digest(template_file)}
+
+        settings = {}
+
+        for setting in RENDER_SETTINGS:
+            value = getattr(self.config, setting)
+            settings[setting] = value[rule] if isinstance(value, dict) and rule in value else value
+
+        # the style files themselves, as well as their names
+        styles = [self.config.citeproc_style[rule], self.config.citeproc_batch_style[rule]]
+        settings['styles'] = [self._digests.file_digest(os.path.join(self.config.csl_style_directory, style + '.csl'))
+                              for style in styles if style]
+
+        settings_digest = digest_value(settings)
+
+        for match in template.placeholders:
+            if match in self.config.section_headings[rule]:
+                inputs[match] = digest_value([settings_digest, self._section_digest(match)])
+            elif match.startswith(EXTERNAL_PREFIX):
+                inputs[match] = None
+            else:
+                inputs[match] = self._digests.file_digest(os.path.join(self.config.sections_directory, match))
+
+        return inputs
+
+    def _section_digest(self, section):
+        """
+        Hashes the items in an eprints section, rereading them only if the data store has changed
+        :param section: the section
+        :return: a hex digest string or None if the section cannot be read
+        """
+        try:
+            signature = self.repo.store.signature(section)
+        except EnvironmentError:
+            return None
+
+        return self._digests.digest('section:' + section, signature,
+                                    lambda: digest_value(getattr(self.repo, section)))
+
+    def _log_missing_data(self, sections):
+        """
+        Explains that eprints sections are missing from the data store
+        :param sections: the names of the sections
+        :return: nothing
+        """
+        self.logger.error('The {0} data store has no {1}: run "genCV.py fetch {2}" to build it'.format(
+            self.config.storage_backend, ', '.join(sections), ' '.join(sections)))
 
     def _load_template(self, template):
         """
-        Load a template file from disk
+        Load a compiled template, parsing it from disk only if it is new or has changed
         :param template: the file to load
-        :return: a string of the template or None if the operation fails
+        :return: a CompiledTemplate or None if the operation fails
         """
         try:
-            with open(template, 'r') as f:
-                content = [line.rstrip('\n') for line in f]
-
-            return '\n'.join(content)
+            return self.templates.get(template)
         except EnvironmentError:
             self.logger.error('Cannot load template from {0}'.format(template))
             return None
 
-    def _substitute_template(self, template, rule):
+    def _substitute_template(self, template, rule, inputs=None, previous_sections=None, sections=None):
         """
         Substitute in sections and eprint sections into a template document
-        :param template: the template string
+        :param template: the CompiledTemplate
+        :param rule: the rule
+        :param inputs: the hashes of the placeholders' inputs (see _rule_inputs), or None to render every section
+        :param previous_sections: the eprints sections rendered by the last build, reused where their inputs match
+        :param sections: a dictionary that is filled with the rendered eprints sections
         :return: a substituted template
         """
-        matches = re.findall('{{(.+?)}}', template)
-        for match in matches:
+        substitutes = {}
+        previous_sections = previous_sections or {}
+
+        for match in template.placeholders:
             self.logger.debug("Processing template section '{0}'".format(match))
-            section = re.compile(r'{{' + match + '}}')
             if match in self.config.section_headings[rule]:
-                substitute = self._eprint_substitute(match, rule)
-            elif match.startswith('external:'):
-                # run an external command that yields a section into a specified file
+                if inputs is not None and inputs[match] is not None and match in previous_sections and \
+                        previous_sections[match][0] == inputs[match]:
+                    self.logger.debug("Section '{0}' is unchanged".format(match))
+                    self.metrics.increment('section_cache_hits_total', labels={'rule': rule})
+                    substitute = previous_sections[match][1]
+                else:
+                    if inputs is not None:
+                        self.metrics.increment('section_cache_misses_total', labels={'rule': rule})
+
+                    substitute = self._eprint_substitute(match, rule)
+
+                if substitute is None:
+                    return False
+
+                if sections is not None and inputs is not None:
+                    sections[match] = [inputs[match], substitute]
+            elif match.startswith(EXTERNAL_PREFIX):
+                # an external command that yields a section into a specified file
                 # these should be in the format:
                 # external:path_to_executable:working_directory:output_file
-                split_line = match.split(':')
+                with self.metrics.timer('external sections'):
+                    substitute = self.externals.get(match)
 
-                subprocess.call(split_line[1], shell=True, cwd=split_line[2])
-
-                with open(split_line[3], 'r') as external_file:
-                    substitute = external_file.read()
+                if substitute is None:
+                    return False
             else:
                 try:
-                    section_file = "sections/" + match
-                    with open(section_file) as f:
-                        content = [line.rstrip('\n') for line in f]
-                        substitute = '\n'.join(content)
+                    substitute = self.sections.get(match)
                 except EnvironmentError:
-                    self.logger.error('Cannot load section.')
+                    self.logger.error('Cannot load section {0}.'.format(match))
                     return False
 
-            template = section.sub(str(substitute), template)
+            substitutes[match] = str(substitute)
 
-        return template
+        return template.render(substitutes)
 
     @staticmethod
     def _build_date(item):
@@ -182,13 +575,7 @@ class CiteProc:
         if not self.config.italicize_titles[rule]:
             return
 
-        # build a cached list of italic regexen if it doesn't exist
-        if len(self.cached_italic_regexen) == 0:
-            for italic in self.config.titles_to_italicize:
-                self.cached_italic_regexen.append(re.compile(r'(\W|^)({0})(\W|$)'.format(italic)))
-
-        for italic in self.cached_italic_regexen:
-            item['title'] = re.sub(italic, r'\1<i>\2</i>\3', item['title'])
+        item['title'] = self.title_matcher.italicize(item['title'])
 
     def _link_to_official_url_if_gold_oa(self, item, rule):
         """
@@ -269,22 +656,122 @@ class CiteProc:
 
         return line
 
+    def _get_citeproc_response(self, citeproc_style, output, rule):
+        """
+        Queue a request to the rendering engine for a rule
+        :param citeproc_style: the citeproc style name
+        :param output: the CSL-JSON payload
+        :param rule: the rule
+        :return: a future that resolves to the JSON response
+        """
+        return self.engines[self.config.citeproc_engine[rule]].submit(citeproc_style, output)
+
+    @staticmethod
+    def _substitution_keys(csl_item):
+        """
+        Builds the set of values on which CSL's subsequent-author-substitute could match an item to its neighbour
+        :param csl_item: the CSL-JSON item
+        :return: a set of keys
+        """
+        keys = set()
+
+        # the name that is substituted may come from any of these fields (an editor stands in for a missing author, and
+        # a title for missing names), so values are compared without the field that they came from
+        for field in ['author', 'editor', 'title']:
+            if field in csl_item:
+                keys.add(repr(csl_item[field]))
+
+                # some substitution rules match on the first name alone, or on each name in turn
+                if isinstance(csl_item[field], list):
+                    keys.update(repr(name) for name in csl_item[field])
+
+        return keys
+
+    def _request_style(self, rule):
+        """
+        The style in which the items of a rule are rendered
+        :param rule: the rule
+        :return: the citeproc style name
+        """
+        if self.config.citeproc_batch_size[rule] > 1 and self.config.citeproc_batch_style[rule]:
+            return self.config.citeproc_batch_style[rule]
+
+        return self.config.citeproc_style[rule]
+
+    def _build_batches(self, pending, output_list, rule):
+        """
+        Groups the items that need rendering into requests for the citeproc server
+        :param pending: the indexes into output_list of items that need rendering
+        :param output_list: the per-item CSL-JSON payloads
+        :param rule: the rule
+        :return: a list of (style, list of indexes) tuples, one per request
+        """
+        batch_size = self.config.citeproc_batch_size[rule]
+        style = self._request_style(rule)
+
+        # without batching we have to do this _every_ time because otherwise the CSL substitutes in "---"
+        if batch_size <= 1:
+            return [(style, [index]) for index in pending]
+
+        # a style with subsequent-author-substitute disabled can take any items together
+        if self.config.citeproc_batch_style[rule]:
+            return [(style, pending[i:i + batch_size]) for i in range(0, len(pending), batch_size)]
+
+        # otherwise, only put items together when no two of them share names (or a title) that could be substituted
+        batches = []
+        batch_keys = []
+
+        for index in pending:
+            csl_item = list(output_list[index]['items'].values())[0]
+            keys = self._substitution_keys(csl_item)
+
+            for batch, used_keys in zip(batches, batch_keys):
+                if len(batch) < batch_size and used_keys.isdisjoint(keys):
+                    batch.append(index)
+                    used_keys.update(keys)
+                    break
+            else:
+                batches.append([index])
+                batch_keys.append(keys)
+
+        return [(style, batch) for batch in batches]
+
     @staticmethod
-    def _get_citeproc_response(citeproc_server, citeproc_style, output, rule, port):
-        # we have to do this _every_ time sadly because otherwise the CSL substitutes in "---"
-        r = requests.post(
-            '{0}?bibliography=1&responseformat=json&style={1}'.format(citeproc_server.format(port),
-                                                                      citeproc_style[rule]),
-            json=output)
+    def _split_batch_response(json_response, identifiers):
+        """
+        Splits a multi-item bibliography response into per-item responses using the entry identifiers
+        :param json_response: the JSON response from citeproc
+        :param identifiers: the identifiers of the items in the request
+        :return: a list of responses, in the same order as identifiers, shaped as if each item was sent alone
+        """
+        if len(identifiers) == 1:
+            return [json_response]
 
-        return r.json()
+        meta = json_response['bibliography'][0]
+        entries = {}
+
+        for entry_ids, entry in zip(meta['entry_ids'], json_response['bibliography'][1]):
+            entries[entry_ids[0]] = entry
+
+        responses = []
+
+        for identifier in identifiers:
+            item_meta = dict(meta)
+            if identifier in entries:
+                item_meta['entry_ids'] = [[identifier]]
+                responses.append({'bibliography': [item_meta, [entries[identifier]]]})
+            else:
+                item_meta['entry_ids'] = []
+                responses.append({'bibliography': [item_meta, []]})
+
+        return responses
 
     def _eprint_substitute(self, section, rule):
         """
         Substitute in a section from the repository
         :param section: the section
         :param rule: the rule
-        :return: the output for a section
+        :return: the output for a section, or None if it cannot be rendered
         """
         # load up the templates for this section
         self.logger.debug("Loading sub-templates for {0} {1}".format(rule, section))
@@ -295,7 +782,11 @@ class CiteProc:
 
         # get the items from the repo
         self.logger.debug("Fetching {0} from repo".format(section))
-        section_items = self.repo.__getattr__(section)
+        section_items = getattr(self.repo, section)
+
+        if section_items is None:
+            self._log_missing_data([section])
+            return None
 
         current_date = ''
 
@@ -316,15 +807,19 @@ class CiteProc:
         else:
             exclude_venues = []
 
+        # responses are cached under the style that the requests use (see _build_batches)
+        request_style = self._request_style(rule)
+
         output_list = []
         identifier_list = []
-        starmap_args = []
+        json_response = []
+        cache_keys = []
+        pending = []
         the_date_list = []
         item_list = []
-        port_var = 0
+        stage_started = time.monotonic()
+
         for item in section_items:
-            port = self.config.citeproc_ports[port_var % len(self.config.citeproc_ports)]
-            port_var += 1
             if 'publication' in item and item['publication'] in exclude_venues:
                 item_count -= 1
             else:
@@ -377,7 +872,15 @@ class CiteProc:
                 identifier_list.append(identifier)
                 the_date_list.append(the_date)
 
-                starmap_args.append((self.config.citeproc_server, self.config.citeproc_style, output, rule, port))
+                # only go to the citeproc server if we haven't rendered this item in this style before
+                cache_key = self.cache.key(self.config.citeproc_engine[rule], request_style, output)
+                cached_response = self.cache.get(cache_key)
+
+                if cached_response is None:
+                    pending.append(len(json_response))
+
+                json_response.append(cached_response)
+                cache_keys.append(cache_key)
 
                 output = {}
                 items = {}
@@ -385,9 +888,52 @@ class CiteProc:
 
                 counter += 1
 
-        # spawn requests to citeproc server(s) using multiprocessing
-        with Pool() as p:
-            json_response = p.starmap(self._get_citeproc_response, starmap_args)
+        self.metrics.add_time('csl building', time.monotonic() - stage_started)
+
+        labels = {'rule': rule, 'section': section}
+        self.metrics.set_value('section_items', item_count, labels)
+        self.metrics.set_value('excluded_venue_items', len(section_items) - item_count, labels)
+        self.metrics.increment('citeproc_cache_hits_total', len(json_response) - len(pending), {'rule': rule})
+        self.metrics.increment('citeproc_cache_misses_total', len(pending), {'rule': rule})
+
+        self.logger.debug("{0} of {1} items in {2} served from the citeproc cache".format(
+            len(json_response) - len(pending), len(json_response), section))
+
+        # group the remaining items into requests, each with a combined payload
+        batches = self._build_batches(pending, output_list, rule)
+        futures = []
+
+        if len(batches) > 0 and self.config.citeproc_engine[rule] == 'http' and not self._ensure_started():
+            return None
+
+        # send the requests to the citeproc server(s) concurrently
+        for style, batch in batches:
+            batch_output = {'items': {}}
+
+            for index in batch:
+                batch_output['items'].update(output_list[index]['items'])
+
+            futures.append(self._get_citeproc_response(style, batch_output, rule))
+
+        for (style, batch), future in zip(batches, futures):
+            # the requests run concurrently, so this is the wall time that the section waits on them
+            with self.metrics.timer('citeproc waits'):
+                try:
+                    response = future.result()
+                except requests.RequestException as exc:
+                    # the items of a failed request are left out of the section rather than failing the build
+                    with self._incomplete_lock:
+                        self._incomplete_rules.add(rule)
+
+                    self.logger.error("citeproc request for {0} {1} (items {2}) failed: {3}".format(
+                        rule, section, ', '.join(str(identifier_list[index]) for index in batch), exc))
+                    continue
+
+            item_responses = self._split_batch_response(response, [identifier_list[index] for index in batch])
+
+            for index, item_response in zip(batch, item_responses):
+                json_response[index] = item_response
+                self.cache.put(cache_keys[index], item_response)
 
         loop_counter = 0
 
@@ -434,7 +980,7 @@ class CiteProc:
 
     def _append_item(self, current_date, item, item_templates, item_templates_new_date, json_response, oa_status,
                      output_string, the_date):
-        if len(json_response['bibliography'][1]) > 0:
+        if json_response is not None and len(json_response['bibliography'][1]) > 0:
             if current_date != the_date:
                 line = self._substitute_item_template(item_templates_new_date,
                                                       json_response['bibliography'][1][0], the_date,
@@ -0,0 +1,294 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import ResponseCache
+from dispatcher import PortDispatcher
+from engines import Engine
+from metrics import Metrics
+
+# a minimal item used to check that a server is up and to have it load a style
+WARM_UP_PAYLOAD = {'items': {'warm-up': {'id': 'warm-up', 'type': 'book', 'title': 'Warm-up',
+                                         'issued': {'date-parts': [[2000]]}}}}
+
+
+class CiteProcClient(Engine):
+    def __init__(self, config, logger, metrics=None):
+        """
+        Initialise a concurrent client for the citeproc-js-server(s) with a pooled, keep-alive session per port
+        :param config: a configuration
+        :param logger: a logger
+        :param metrics: the Metrics in which to record the time spent in requests (a new one if None)
+        """
+        self.config = config
+        self.logger = logger
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.dispatcher = PortDispatcher(config.citeproc_ports, config.citeproc_max_failures,
+                                         config.citeproc_retry_after)
+
+        self._executor = None
+        self._hedge_executor = None
+        self._sessions = {}
+        # cache keys to (future, item identifiers) of the requests made since the last clear()
+        self._shared = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ports(self):
+        return self.dispatcher.ports
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self.logger.debug("Starting citeproc client with {0} workers".format(self.config.citeproc_workers))
+                self._executor = ThreadPoolExecutor(max_workers=self.config.citeproc_workers)
+
+            return self._executor
+
+    def _get_hedge_executor(self):
+        with self._lock:
+            if self._hedge_executor is None:
+                # hedged requests need threads of their own as the workers block waiting on them
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.config.citeproc_workers * 2)
+
+            return self._hedge_executor
+
+    def _get_session(self, port):
+        with self._lock:
+            if port not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config.citeproc_workers)
+                session.mount(self.config.citeproc_server.format(port), adapter)
+                self._sessions[port] = session
+
+            return self._sessions[port]
+
+    def _post(self, style, payload, port):
+        """
+        Send a bibliography request to a citeproc server
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :param port: the port of the server to use
+        :return: the JSON response
+        """
+        session = self._get_session(port)
+        start = time.monotonic()
+
+        try:
+            r = session.post('{0}?bibliography=1&responseformat=json&style={1}'.format(
+                self.config.citeproc_server.format(port), style), json=payload,
+                timeout=self.config.citeproc_timeout)
+            r.raise_for_status()
+            response = r.json()
+        except (requests.RequestException, ValueError):
+            self.dispatcher.release(port, time.monotonic() - start, False)
+            self.metrics.add_time('citeproc round trips', time.monotonic() - start)
+            self.metrics.increment('citeproc_requests_total', labels={'port': port, 'outcome': 'failure'})
+            raise
+
+        latency = time.monotonic() - start
+        self.dispatcher.release(port, latency, True)
+        self.metrics.add_time('citeproc round trips', latency)
+        self.metrics.increment('citeproc_requests_total', labels={'port': port, 'outcome': 'success'})
+        self.metrics.observe('citeproc_request_seconds', latency, {'port': port})
+
+        return response
+
+    def _hedged_post(self, style, payload, port):
+        """
+        Send a bibliography request, duplicating it on a second port if it is slower than the p95 latency
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :param port: the port of the server to use first
+        :return: the JSON response of whichever request succeeds first
+        """
+        p95 = self.dispatcher.percentile(0.95)
+
+        if not self.config.citeproc_hedge or p95 is None or len(self.ports) < 2:
+            return self._post(style, payload, port)
+
+        executor = self._get_hedge_executor()
+        futures = [executor.submit(self._post, style, payload, port)]
+
+        done, not_done = wait(futures, timeout=p95)
+
+        if len(done) == 0:
+            hedge_port = self.dispatcher.acquire(exclude=[port])
+            self.logger.debug("Hedging a slow citeproc request on port {0} to port {1}".format(port, hedge_port))
+            self.metrics.increment('citeproc_hedged_requests_total')
+            futures.append(executor.submit(self._post, style, payload, hedge_port))
+
+        # take the first success, only raising if every attempt failed
+        while True:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+            if len(not_done) == 0:
+                return futures[0].result()
+
+            futures = list(not_done)
+
+    def _render(self, style, payload):
+        """
+        Send a bibliography request to the least-loaded port, retrying on other ports if it fails
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :return: the JSON response
+        """
+        tried = []
+
+        while True:
+            port = self.dispatcher.acquire(exclude=tried)
+
+            try:
+                return self._hedged_post(style, payload, port)
+            except (requests.RequestException, ValueError) as exc:
+                tried.append(port)
+
+                if len(tried) > self.config.citeproc_retries or len(tried) >= len(self.ports):
+                    raise
+
+                self.logger.warning("citeproc request to port {0} failed ({1}), retrying".format(port, exc))
+                self.metrics.increment('citeproc_retries_total')
+
+    def _wait_for_port(self, port, styles, deadline, interval):
+        """
+        Poll a citeproc server until it renders a warm-up item in every style
+        :param port: the port of the server
+        :param styles: the citeproc style names to load
+        :param deadline: the time.monotonic() value at which to give up
+        :param interval: the delay between attempts in seconds
+        :return: True if the server is ready, otherwise False
+        """
+        session = self._get_session(port)
+        remaining_styles = list(styles)
+
+        while len(remaining_styles) > 0:
+            try:
+                r = session.post('{0}?bibliography=1&responseformat=json&style={1}'.format(
+                    self.config.citeproc_server.format(port), remaining_styles[0]), json=WARM_UP_PAYLOAD,
+                    timeout=max(deadline - time.monotonic(), interval))
+                r.raise_for_status()
+                r.json()
+                remaining_styles.pop(0)
+            except (requests.RequestException, ValueError):
+                if time.monotonic() + interval > deadline:
+                    return False
+                time.sleep(interval)
+
+        return True
+
+    def wait_until_ready(self, styles):
+        """
+        Wait for the configured citeproc servers to come up, putting those that do (and only those) into rotation
+        Every configured port is probed on each call, so a server that failed to start before is tried again
+        :param styles: the citeproc style names that each server should load while warming up
+        :return: a list of ready ports (if it is empty, the rotation is left as it was)
+        """
+        deadline = time.monotonic() + self.config.citeproc_ready_timeout
+        interval = self.config.citeproc_ready_interval
+        ports = list(self.config.citeproc_ports)
+
+        if len(ports) == 0:
+            return []
+
+        with ThreadPoolExecutor(max_workers=len(ports)) as executor:
+            ready = list(executor.map(lambda port: self._wait_for_port(port, styles, deadline, interval), ports))
+
+        ready_ports = [port for port, is_ready in zip(ports, ready) if is_ready]
+
+        for port, is_ready in zip(ports, ready):
+            if not is_ready:
+                self.logger.error("citeproc-js-server on port {0} did not become ready within {1}s".format(
+                    port, self.config.citeproc_ready_timeout))
+
+        if len(ready_ports) > 0:
+            self.dispatcher.set_ports(ready_ports)
+
+        return ready_ports
+
+    def submit(self, style, payload):
+        """
+        Queue a bibliography request, sharing the result with any identical request made since the last clear()
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :return: a future that resolves to the JSON response
+        """
+        # requests are shared on the same key as the response cache, ignoring the positional item identifiers
+        key = ResponseCache.key('http', style, payload)
+        identifiers = list(payload['items'].keys())
+        executor = self._get_executor()
+
+        with self._lock:
+            if key not in self._shared:
+                self._shared[key] = (executor.submit(self._render, style, payload), identifiers)
+                return self._shared[key][0]
+
+            self.logger.debug("Sharing an identical citeproc request")
+            self.metrics.increment('citeproc_shared_requests_total')
+            future, shared_identifiers = self._shared[key]
+
+        if shared_identifiers == identifiers:
+            return future
+
+        return self._rename_entries(future, dict(zip(shared_identifiers, identifiers)))
+
+    @staticmethod
+    def _rename_entries(future, renames):
+        """
+        Wraps a shared request so that its response refers to the identifiers of another request for the same items
+        :param future: the future of the shared request
+        :param renames: a dictionary of the shared request's item identifiers to those of the other request
+        :return: a future that resolves to the JSON response
+        """
+        renamed = Future()
+
+        def rename(shared):
+            try:
+                response = shared.result()
+            except Exception as exc:
+                renamed.set_exception(exc)
+                return
+
+            meta = dict(response['bibliography'][0])
+            meta['entry_ids'] = [[renames.get(identifier, identifier) for identifier in entry_ids]
+                                 for entry_ids in meta['entry_ids']]
+            renamed.set_result({'bibliography': [meta, response['bibliography'][1]]})
+
+        future.add_done_callback(rename)
+
+        return renamed
+
+    def clear(self):
+        """
+        Forget the responses shared between requests
+        :return: nothing
+        """
+        with self._lock:
+            self._shared = {}
+
+    def close(self):
+        """
+        Wait for outstanding requests and release the worker threads and connections
+        :return: nothing
+        """
+        with self._lock:
+            executors = [self._executor, self._hedge_executor]
+            sessions = list(self._sessions.values())
+            self._executor = None
+            self._hedge_executor = None
+            self._sessions = {}
+            self._shared = {}
+
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+        for session in sessions:
+            session.close()
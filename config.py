@@ -72,8 +72,35 @@ eprints_db = {'all_books': "book",
               'book_chapters': "book_section",
               'conference_items': "conference_item"}
 
+# the number of bytes read at a time when streaming the eprints data
+stream_chunk_size = 65536
+
+# the number of processes used to classify items from eprints into output types (1 classifies in this process)
+# this only pays off for very large, department-scale exports
+classification_workers = 1
+
+# the number of items classified (and held in memory) at a time
+classification_chunk_size = 5000
+
+# the data store for parsed sections: 'sqlite' keeps each item once in storage['db'], with each section a list of
+# eprint ids, 'binary' does the same in a single compact file (storage['binary']) that is decoded in one pass, and
+# 'jsonl' writes a full copy of every item into each section's file below (these files can also be written from the
+# other stores with "genCV.py export")
+# each backend keeps its own files, so after changing it (or upgrading from a version that only wrote JSON-lines files)
+# run "genCV.py fetch" to build the new store from the downloaded export
+storage_backend = 'sqlite'
+
+# the zlib compression level (1-9) for the binary store, or 0 to store it uncompressed (compression makes the file
+# about a third of the size, but takes longer to load: see benchmarks/storage.py)
+storage_compression = 0
+
 # this section determines data storage locations
 storage = {'json': 'data/eprints.json',
+           'json_validators': 'data/eprints.validators.json',
+           'db': 'data/eprints.db',
+           'binary': 'data/eprints.bin',
+           'manifest': 'data/manifest.json',
+           'externals': 'data/externals.json',
            'all_books': "data/all_books.json",
            'unedited_books': "data/unedited_books.json",
            'edited_books': "data/edited_books.json",
@@ -88,20 +115,73 @@ storage = {'json': 'data/eprints.json',
 # this controls the default types to parse if nothing is given on the command line
 default_types = ['unedited_books', 'edited_books', 'peer_reviewed_articles']
 
+# the directory of static sections, which templates include as {{Name}} for sections/Name
+sections_directory = 'sections'
+
 # this controls output documents
 # a dictionary of lists, the first entry in each list should be a template, the second a file destination, then a series
 # of operations required to create the output (the latter optional)
+# an operation of the form 'print:<file>' prints the destination to a PDF file (see print_command), while any other
+# operation is run as a shell command
 output_rules = {'html': ['templates/HTML',
                          'output/Eve-CV.html'],
 
                 'pdf': ['templates/PDF',
                         'output/Eve-CV-PDF.html',
-                        'screen -S serve -d -m bash -c "python3 -m http.server"',
-                        'sleep 2',
-                        'nodejs ./print.js',
-                        'screen -S serve -X quit',
+                        'print:output/Eve-CV.pdf',
                         ]}
 
+# batch mode ("genCV.py batch") builds CVs for a list of eprints users, each with their own data and output directories
+# (the template and sections are shared); exports are fetched by batch_fetch_workers threads and users are built by
+# batch_workers processes, which share the citeproc servers, citeproc_workers and the response cache
+batch_data_directory = 'data/users'
+batch_output_directory = 'output/users'
+batch_fetch_workers = 8
+batch_workers = 4
+
+# whether "make" keeps a manifest of content hashes (storage['manifest']) so that it only re-renders the sections whose
+# data, template, settings or style have changed, and leaves an output (and its shell steps) alone if it is unchanged
+incremental_builds = True
+
+# watch mode ("genCV.py watch") polls these directories (and the data store) every watch_interval seconds and
+# rebuilds the affected rules once there have been no further changes for watch_debounce seconds
+watch_directories = [sections_directory, 'templates']
+watch_interval = 0.2
+watch_debounce = 0.3
+
+# serve mode ("genCV.py serve") renders output types on request at http://serve_host:serve_port/<output type>,
+# checking every serve_refresh_interval seconds whether their inputs have changed and re-rendering them if so
+serve_host = '127.0.0.1'
+serve_port = 8000
+serve_refresh_interval = 5
+
+# the commands of external sections ({{external:command:working_directory:output_file}} in a template) are run by up to
+# external_workers threads at once; an output file is reused without re-running its command while it is unchanged
+# and the command last ran less than external_ttl seconds ago (0 re-runs commands on every build)
+external_workers = 4
+external_ttl = 3600
+
+# the command that prints an HTML document to PDF, which is given the document's URL (on a static file server started
+# for the purpose), the PDF file and print_timeout in milliseconds, and which waits for the document to signal that
+# its layout is complete
+print_command = 'nodejs ./print.js'
+print_timeout = 60
+
+# "--profile" on fetch or make profiles the run with yappi (across threads and classification processes), writing
+# <command>.callgrind and <command>.pstats to profile_directory, and prints the time spent in each stage
+profile_directory = 'profile'
+
+# if set, each "fetch" or "make" run writes its metrics (items per section, excluded venues, citeproc requests and
+# their latency per port, cache hit ratios, bytes downloaded, the duration of each rule and stage, and whether the run
+# succeeded) to metrics_file, with {command} replaced by the command, in metrics_format: 'json' or 'prometheus' (the
+# text format read by the node exporter's textfile collector, e.g. 'metrics/{command}.prom')
+metrics_file = None
+metrics_format = 'prometheus'
+
+# whether to build multiple output rules at the same time
+# rules that share a citeproc style also share the requests to the citeproc server
+parallel_rules = True
+
 # define the section template
 section_template = {'pdf': '<div id="{0}">{1}</div>',
                     'html': '<div id="{0}">{1}</div>'}
@@ -142,7 +222,9 @@ italicize_titles = {'pdf': True,
 # i i {
 #   font-style: normal;
 # }
-# Ordering does matter and replacements take place in the order specified
+# Ordering does matter and replacements take place in the order specified: a title found inside an earlier one is
+# nested within it, while a title that would contain or overlap an earlier one is left alone
+# Titles are matched literally (not as regular expressions) and only where delimited by non-word characters
 titles_to_italicize = ['Cloud Atlas', 'Abortion Eve', 'I’m Jack', 'Station Eleven', 'Point Omega',
                        'Affinity', 'C', 'Saint Antony in His Desert', 'Enumerations: Data and Literary Study',
                        'Making Literature Now', 'Mere Reading: The Poetics of Wonder in Modern American Novels',
@@ -248,11 +330,57 @@ citeproc_type_mapper = {'all_books': "book",
 citeproc_style = {'pdf': 'modern-humanities-research-association',
                   'html': 'modern-humanities-research-association'}
 
+# the number of items to send to the citeproc server in a single request (1 sends each item on its own)
+# items that share names are never sent together, as CSL would replace the repeated names with "---"
+citeproc_batch_size = {'pdf': 1,
+                       'html': 1}
+
+# optionally, a copy of the citeproc style with subsequent-author-substitute removed, installed on the citeproc server
+# when this is set, batches are filled without regard to shared names
+citeproc_batch_style = {'pdf': None,
+                        'html': None}
+
+# the rendering engine for each rule
+# 'http' sends items to citeproc-js-server(s); 'python' renders them in-process with citeproc-py
+citeproc_engine = {'pdf': 'http',
+                   'html': 'http'}
+
+# the directory of .csl files used by the python engine (citeproc-py's bundled styles are used as a fallback)
+csl_style_directory = citeproc_js_server_directory + '/csl'
+
 # the fire-up address of the citeproc server
 citeproc_server = 'http://127.0.0.1:{0}'
 
-# citeproc startup delay
-citeproc_delay = 7
+# the maximum time to wait for the citeproc server(s) to start, in seconds
+citeproc_ready_timeout = 30
+
+# the delay between readiness checks while the citeproc server(s) start, in seconds
+citeproc_ready_interval = 0.25
+
+# the maximum number of concurrent requests to the citeproc server(s)
+citeproc_workers = 24
+
+# the timeout for a single request to a citeproc server, in seconds
+citeproc_timeout = 30
+
+# the number of other ports to try when a request to a citeproc server fails
+citeproc_retries = 2
+
+# the number of consecutive failures after which a citeproc port is taken out of rotation
+citeproc_max_failures = 3
+
+# the number of seconds before a port that was taken out of rotation is tried again
+citeproc_retry_after = 30
+
+# whether to send a duplicate request to a second port when a request is slower than the p95 latency
+citeproc_hedge = False
 
 # citeproc ports
 citeproc_ports = ['8085', '8086', '8087', '8088', '8089', '8090', '8091', '8092', '8093', '8094', '8095', '8096']
+
+
+# the directory for the persistent cache of citeproc responses (set to None to disable)
+citeproc_cache_directory = 'data/cache'
+
+# the maximum number of citeproc responses to keep in the cache
+citeproc_cache_size = 20000
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+
+
+class PortDispatcher:
+    def __init__(self, ports, max_failures, retry_after, sample_size=200):
+        """
+        Initialise a load-aware dispatcher over a pool of citeproc ports
+        :param ports: a list of ports
+        :param max_failures: the number of consecutive failures after which a port is taken out of rotation
+        :param retry_after: the number of seconds before an unhealthy port is tried again
+        :param sample_size: the number of recent request latencies to keep for percentile estimates
+        """
+        self.max_failures = max_failures
+        self.retry_after = retry_after
+
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=sample_size)
+        self._ports = {}
+
+        self.set_ports(ports)
+
+    def set_ports(self, ports):
+        """
+        Replace the ports in rotation
+        :param ports: a list of ports
+        :return: nothing
+        """
+        with self._lock:
+            self._ports = {port: {'in_flight': 0, 'failures': 0, 'unhealthy_until': 0.0, 'latency': None}
+                           for port in ports}
+
+    @property
+    def ports(self):
+        with self._lock:
+            return list(self._ports.keys())
+
+    def acquire(self, exclude=()):
+        """
+        Pick the least-loaded healthy port (requests in flight weighted by latency) and mark a request in flight on it
+        :param exclude: ports that should not be picked (e.g. because they already failed for this request)
+        :return: a port, or None if every port is excluded
+        """
+        with self._lock:
+            now = time.monotonic()
+            candidates = [port for port in self._ports if port not in exclude]
+
+            if len(candidates) == 0:
+                return None
+
+            # fall back to unhealthy ports rather than failing outright
+            healthy = [port for port in candidates if self._ports[port]['unhealthy_until'] <= now]
+
+            if len(healthy) > 0:
+                candidates = healthy
+
+            # the port expected to finish a new request soonest, given what it already has in flight
+            port = min(candidates, key=lambda p: (
+                (self._ports[p]['in_flight'] + 1) * (self._ports[p]['latency'] or 0.0),
+                self._ports[p]['in_flight']))
+            self._ports[port]['in_flight'] += 1
+
+            return port
+
+    def release(self, port, latency, succeeded):
+        """
+        Record the outcome of a request
+        :param port: the port the request was sent to
+        :param latency: the time the request took, in seconds
+        :param succeeded: whether the request succeeded
+        :return: nothing
+        """
+        with self._lock:
+            if port not in self._ports:
+                return
+
+            stats = self._ports[port]
+            stats['in_flight'] -= 1
+
+            if succeeded:
+                stats['failures'] = 0
+                stats['unhealthy_until'] = 0.0
+                # an exponentially weighted moving average of the port's latency
+                stats['latency'] = latency if stats['latency'] is None else 0.8 * stats['latency'] + 0.2 * latency
+                self._samples.append(latency)
+            else:
+                stats['failures'] += 1
+                if stats['failures'] >= self.max_failures:
+                    stats['unhealthy_until'] = time.monotonic() + self.retry_after
+
+    def percentile(self, fraction, min_samples=20):
+        """
+        Estimate a latency percentile over recent successful requests
+        :param fraction: the percentile as a fraction (e.g. 0.95)
+        :param min_samples: the number of samples required before an estimate is given
+        :return: the latency in seconds, or None if there are not enough samples
+        """
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+
+            samples = sorted(self._samples)
+
+        return samples[int(fraction * (len(samples) - 1))]
@@ -0,0 +1,172 @@
+import importlib
+import importlib.machinery
+import importlib.util
+import os
+import sys
+import threading
+from concurrent.futures import Future
+
+
+class Engine:
+    """
+    The interface for a bibliography rendering engine. Engines accept CSL-JSON payloads and produce responses in the
+    shape of citeproc-js-server's JSON bibliography output: {'bibliography': [{'entry_ids': [[id], ...]}, [entry, ...]]}
+    """
+
+    def submit(self, style, payload):
+        """
+        Queue a bibliography request
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :return: a future that resolves to the JSON response
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Forget any responses shared within a build
+        :return: nothing
+        """
+        pass
+
+    def close(self):
+        """
+        Release any resources held by the engine
+        :return: nothing
+        """
+        pass
+
+
+def _import_citeproc_py():
+    """
+    Imports citeproc-py, which shares its package name with this project's citeproc module, as citeproc_py
+    :return: the citeproc_py module
+    """
+    if 'citeproc_py' in sys.modules:
+        return sys.modules['citeproc_py']
+
+    # look for the installed package everywhere except this project's directory
+    here = os.path.dirname(os.path.abspath(__file__))
+    search_path = [path for path in sys.path if os.path.abspath(path or os.curdir) != here]
+    spec = importlib.machinery.PathFinder.find_spec('citeproc', search_path)
+
+    if spec is None or spec.submodule_search_locations is None:
+        raise ImportError('The python engine requires citeproc-py (pip install citeproc-py)')
+
+    # citeproc-py only uses relative imports, so it can live under another name
+    package_spec = importlib.util.spec_from_file_location('citeproc_py', spec.origin,
+                                                          submodule_search_locations=spec.submodule_search_locations)
+    module = importlib.util.module_from_spec(package_spec)
+    sys.modules['citeproc_py'] = module
+    package_spec.loader.exec_module(module)
+
+    for submodule in ['citeproc_py.frontend', 'citeproc_py.source', 'citeproc_py.source.json']:
+        importlib.import_module(submodule)
+
+    return module
+
+
+class PythonEngine(Engine):
+    def __init__(self, config, logger):
+        """
+        Initialise an in-process CSL engine backed by citeproc-py
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.config = config
+        self.logger = logger
+
+        self._styles = {}
+        self._lock = threading.Lock()
+        self._citeproc = None
+
+    def _get_style(self, style):
+        """
+        Load a CSL style, preferring a .csl file in config.csl_style_directory over citeproc-py's bundled styles
+        :param style: the citeproc style name
+        :return: a CitationStylesStyle
+        """
+        if style not in self._styles:
+            style_file = os.path.join(self.config.csl_style_directory, style + '.csl')
+
+            if os.path.isfile(style_file):
+                self.logger.debug("Loading CSL style from {0}".format(style_file))
+                self._styles[style] = self._citeproc.frontend.CitationStylesStyle(style_file, validate=False)
+            else:
+                self._styles[style] = self._citeproc.frontend.CitationStylesStyle(style, validate=False)
+
+        return self._styles[style]
+
+    @staticmethod
+    def _literal_dates(csl_item):
+        """
+        Replace date-parts that are not numbers (e.g. "n.d." for an undated item) with a literal date, since citeproc-js
+        renders them as given but citeproc-py cannot compare them
+        :param csl_item: the CSL-JSON item
+        :return: the item, copied if a date was replaced
+        """
+        issued = csl_item.get('issued')
+
+        if issued is None or all(isinstance(part, int) for parts in issued.get('date-parts', []) for part in parts):
+            return csl_item
+
+        csl_item = dict(csl_item)
+        csl_item['issued'] = {'literal': ' '.join(str(part) for parts in issued['date-parts'] for part in parts)}
+
+        return csl_item
+
+    def _render_item(self, style, csl_item):
+        """
+        Render a single item as a bibliography entry
+        :param style: a CitationStylesStyle
+        :param csl_item: the CSL-JSON item
+        :return: a list of HTML bibliography entries (empty if the style produced nothing)
+        """
+        citeproc_py = self._citeproc
+
+        source = citeproc_py.source.json.CiteProcJSON([self._literal_dates(csl_item)])
+        bibliography = citeproc_py.frontend.CitationStylesBibliography(style, source, citeproc_py.formatter.html)
+        bibliography.register(citeproc_py.source.Citation([citeproc_py.source.CitationItem(csl_item['id'])]))
+
+        # match citeproc-js-server's entry markup, which the item templates rely on
+        return ['<div class="csl-entry">{0}</div>'.format(entry) for entry in bibliography.bibliography()]
+
+    def render(self, style, payload):
+        """
+        Render a bibliography, one item at a time so that CSL never substitutes in "---"
+        :param style: the citeproc style name
+        :param payload: the CSL-JSON payload
+        :return: the JSON response
+        """
+        with self._lock:
+            if self._citeproc is None:
+                self._citeproc = _import_citeproc_py()
+
+            csl_style = self._get_style(style)
+            entry_ids = []
+            entries = []
+
+            for identifier, csl_item in payload['items'].items():
+                # like a failed request to citeproc-js-server, an item that cannot be rendered is left out rather than
+                # failing the whole section
+                try:
+                    rendered = self._render_item(csl_style, csl_item)
+                except Exception as exc:
+                    self.logger.error("Cannot render item {0} with citeproc-py ({1})".format(identifier, exc))
+                    continue
+
+                for entry in rendered:
+                    entry_ids.append([identifier])
+                    entries.append(entry)
+
+        return {'bibliography': [{'entry_ids': entry_ids}, entries]}
+
+    def submit(self, style, payload):
+        future = Future()
+
+        try:
+            future.set_result(self.render(style, payload))
+        except Exception as exc:
+            future.set_exception(exc)
+
+        return future
@@ -0,0 +1,209 @@
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# placeholders of the form external:path_to_executable:working_directory:output_file
+EXTERNAL_PREFIX = 'external:'
+
+
+class ExternalSections:
+    def __init__(self, config, logger):
+        """
+        Initialise a runner for external sections that runs their commands concurrently and memoises the results
+        A result is reused, across rules and runs, while its output file is unchanged since the command wrote it and
+        the command ran less than config.external_ttl seconds ago
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.config = config
+        self.logger = logger
+        self.path = config.storage['externals']
+
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = {}
+        self._contents = {}
+        # whether the memo has changed since it was loaded or last saved
+        self._dirty = False
+
+        try:
+            with open(self.path, 'r') as memo_file:
+                self._memo = json.load(memo_file)
+        except (EnvironmentError, ValueError):
+            self._memo = {}
+
+    @staticmethod
+    def parse(placeholder):
+        """
+        Splits an external placeholder into its parts
+        :param placeholder: the placeholder
+        :return: a (command, working directory, output file) tuple
+        """
+        split_line = placeholder.split(':')
+        return split_line[1], split_line[2], split_line[3]
+
+    @staticmethod
+    def _key(command, cwd, output_file):
+        return json.dumps([command, cwd, output_file])
+
+    def _fresh(self, key, output_file):
+        """
+        Checks whether a memoised run is still valid
+        :param key: the memo key
+        :param output_file: the output file
+        :return: True if the output can be reused without running the command
+        """
+        record = self._memo.get(key)
+
+        if record is None or time.time() - record[1] >= self.config.external_ttl:
+            return False
+
+        try:
+            return os.stat(output_file).st_mtime_ns == record[0]
+        except EnvironmentError:
+            return False
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.config.external_workers)
+
+            return self._executor
+
+    def prefetch(self, placeholders, force=False):
+        """
+        Starts running the commands of any external placeholders whose output is not fresh
+        :param placeholders: a list of placeholders (others are ignored)
+        :param force: whether to run the commands even if their output is fresh
+        :return: nothing
+        """
+        for placeholder in placeholders:
+            if placeholder.startswith(EXTERNAL_PREFIX):
+                self._submit(placeholder, force)
+
+    def _submit(self, placeholder, force=False):
+        """
+        Starts running an external command, unless it is already running or its output is fresh
+        :param placeholder: the external placeholder
+        :param force: whether to run the command even if its output is fresh
+        :return: the key of the run
+        """
+        command, cwd, output_file = self.parse(placeholder)
+        key = self._key(command, cwd, output_file)
+
+        with self._lock:
+            if key in self._pending or (not force and self._fresh(key, output_file)):
+                return key
+
+        executor = self._get_executor()
+
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = executor.submit(self._run, key, command, cwd, output_file)
+
+        return key
+
+    def _run(self, key, command, cwd, output_file):
+        """
+        Runs an external command and records its output file's mtime
+        :param key: the memo key
+        :param command: the command
+        :param cwd: the working directory
+        :param output_file: the output file
+        :return: the exit code of the command, or None if it cannot be run
+        """
+        self.logger.debug("Running external section {0} in {1}".format(command, cwd))
+        started = time.time()
+
+        try:
+            result = subprocess.call(command, shell=True, cwd=cwd)
+        except EnvironmentError as exc:
+            self.logger.error('Cannot run external section {0}: {1}'.format(command, exc))
+            return None
+
+        try:
+            mtime = os.stat(output_file).st_mtime_ns
+        except EnvironmentError:
+            return result
+
+        self.logger.debug("External section {0} took {1:.2f}s".format(command, time.time() - started))
+
+        if result == 0:
+            with self._lock:
+                self._memo[key] = [mtime, started]
+                self._dirty = True
+
+        return result
+
+    def get(self, placeholder):
+        """
+        Fetches the content of an external section, waiting for its command if it is running
+        :param placeholder: the external placeholder
+        :return: the content, or None if it cannot be read
+        """
+        command, cwd, output_file = self.parse(placeholder)
+        key = self._submit(placeholder)
+
+        with self._lock:
+            future = self._pending.get(key)
+
+        if future is not None:
+            future.result()
+
+        try:
+            stat = os.stat(output_file)
+            signature = (stat.st_mtime_ns, stat.st_size)
+
+            with self._lock:
+                if output_file in self._contents and self._contents[output_file][0] == signature:
+                    return self._contents[output_file][1]
+
+            with open(output_file, 'r') as external_file:
+                content = external_file.read()
+        except EnvironmentError:
+            self.logger.error('Cannot read external section from {0}'.format(output_file))
+            return None
+
+        with self._lock:
+            self._contents[output_file] = (signature, content)
+
+        return content
+
+    def clear(self):
+        """
+        Forgets the runs of this build and saves the memo of their results, if any command has run since it was last
+        saved (so that a build that runs nothing does not touch the file, which watch mode would see as a change)
+        :return: nothing
+        """
+        with self._lock:
+            self._pending = {}
+            memo = dict(self._memo)
+            dirty = self._dirty
+            self._dirty = False
+
+        if not dirty:
+            return
+
+        try:
+            handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.tmp')
+            with os.fdopen(handle, 'w') as memo_file:
+                json.dump(memo, memo_file)
+            os.replace(temp_path, self.path)
+        except EnvironmentError:
+            self.logger.warning('Cannot write external section memo to {0}'.format(self.path))
+
+    def close(self):
+        """
+        Waits for any running commands and releases the worker threads
+        :return: nothing
+        """
+        with self._lock:
+            executor = self._executor
+            self._executor = None
+
+        if executor is not None:
+            executor.shutdown(wait=True)
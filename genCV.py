@@ -1,8 +1,12 @@
 """Eprints CV Generator.
 
 Usage:
-  genCV.py fetch [TYPES ...] [--debug] [--refresh]
-  genCV.py make OUTPUT_TYPES... [--debug]
+  genCV.py fetch [TYPES ...] [--debug] [--refresh] [--profile]
+  genCV.py make OUTPUT_TYPES... [--debug] [--force] [--profile]
+  genCV.py export [TYPES ...] [--debug]
+  genCV.py watch OUTPUT_TYPES... [--debug]
+  genCV.py serve OUTPUT_TYPES... [--port=<port>] [--debug]
+  genCV.py batch USERS_FILE OUTPUT_TYPES... [--debug] [--refresh]
   genCV.py (-h | --help)
   genCV.py --version
 
@@ -11,6 +15,9 @@ Options:
   --version     Show version.
   --debug       Enable debug output.
   --refresh     Delete cached versions and do a hard refresh from eprints.
+  --force       Rebuild every section and output, even if unchanged since the last build.
+  --port=<port> The port on which to serve (defaults to config.serve_port).
+  --profile     Profile the run (see config.profile_directory) and print the time spent in each stage.
 
 Info:
 
@@ -28,22 +35,47 @@ Valid options for "types" for the fetch operation, by default, are:
 
 These can be extended using the configuration mapping system.
 
+The watch operation builds the given output types, then keeps the citeproc servers running and rebuilds the
+affected output types whenever a template, section or the fetched data changes, until interrupted.
+
+The serve operation renders the given output types on request over HTTP (the first is served at /, and each at
+/<output type>), re-rendering them in the background when their inputs change.
+
+The batch operation fetches and builds the given output types for every eprints user listed (one per line) in
+USERS_FILE, writing each user's data and outputs into their own directories.
+
+The export operation writes the given types (or all types) from the data store to JSON-lines files.
+
+The --profile option of the fetch and make operations profiles the run with yappi, writing callgrind and pstats files
+to config.profile_directory, and prints the time spent in each stage.
+
 The tool includes two output options by default, "html" and "pdf".
 
+The "pdf" output is printed by print.js (see config.print_command), which requires Node.js and html-pdf-chrome,
+from a static file server that the tool starts for each print.
+
 This tool requires a working copy of citeproc-js-server https://github.com/zotero/citeproc-js-server.
 """
 import sys
+import time
 
 from docopt import docopt
 import logging
 import pygogo as gogo
 import config
+from batch import run_batch
 from citeproc import CiteProc
+from metrics import Metrics
+from profiling import Profiler
 from repository import Repository
+from server import CVService
+from watch import Watcher
 
 app = "ePrints CV Generator 2.2"
 
+from rich.console import Console
 from rich.logging import RichHandler
+from rich.table import Table
 
 FORMAT = "%(message)s"
 logging.basicConfig(
@@ -59,6 +91,47 @@ logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 
+def print_timings(metrics):
+    """
+    Prints a table of the time spent in each stage of a run
+    :param metrics: the Metrics of the run
+    :return: nothing
+    """
+    table = Table(title='Time spent in each stage', caption='Stages overlap, so totals may exceed the wall time')
+    table.add_column('Stage')
+    table.add_column('Calls', justify='right')
+    table.add_column('Total (s)', justify='right')
+    table.add_column('Mean (ms)', justify='right')
+
+    for stage, calls, seconds in metrics.timings():
+        table.add_row(stage, str(calls), '{0:.3f}'.format(seconds), '{0:.2f}'.format(seconds * 1000 / calls))
+
+    Console().print(table)
+
+
+def write_metrics(metrics, command, succeeded, started):
+    """
+    Writes the metrics of a run to config.metrics_file
+    :param metrics: the Metrics of the run
+    :param command: the command that was run
+    :param succeeded: whether the run succeeded
+    :param started: the time.time() at which the run started
+    :return: nothing
+    """
+    metrics.set_value('run_started_seconds', started)
+    metrics.set_value('run_duration_seconds', time.time() - started)
+    metrics.set_value('run_succeeded', int(succeeded))
+
+    path = config.metrics_file.format(command=command)
+
+    try:
+        metrics.write(path, config.metrics_format)
+    except (EnvironmentError, ValueError) as exc:
+        logger.error('Cannot write metrics to {0}: {1}'.format(path, exc))
+        return
+
+    logger.debug('Wrote metrics to {0}'.format(path))
+
 
 def main(args):
     if '--debug' in args and args['--debug']:
@@ -68,23 +141,74 @@ def main(args):
 
     logger.info(app)
 
-    repo = Repository(config, logger, args['--refresh'])
-    citeproc = CiteProc(repo, config, logger)
+    metrics = Metrics()
+    repo = Repository(config, logger, args['--refresh'], metrics)
+    citeproc = CiteProc(repo, config, logger, metrics)
+
+    command = 'fetch' if args['fetch'] else 'make' if args['make'] else None
+    started = time.time()
+    succeeded = False
+    profiler = None
+
+    if args.get('--profile'):
+        profiler = Profiler(config.profile_directory, command, logger)
+
+        if profiler.start():
+            repo.profiler = profiler
+
     try:
         # start the citeproc server if the flag is passed
         if 'fetch' in args and args['fetch']:
             if len(args['TYPES']) > 0:
-                repo.fetch(args['TYPES'])
+                succeeded = repo.fetch(args['TYPES'])
             else:
-                repo.fetch(config.default_types)
+                succeeded = repo.fetch(config.default_types)
+
+        elif 'export' in args and args['export']:
+            if len(args['TYPES']) > 0:
+                repo.export(args['TYPES'])
+            else:
+                repo.export(list(config.eprints_db.keys()))
+
+        elif 'watch' in args and args['watch']:
+            if citeproc.start(args['OUTPUT_TYPES'], lazy=True):
+                Watcher(citeproc, config, logger).run(args['OUTPUT_TYPES'])
+
+        elif 'serve' in args and args['serve']:
+            if citeproc.start(args['OUTPUT_TYPES'], lazy=True):
+                port = int(args['--port']) if args['--port'] else config.serve_port
+                CVService(citeproc, config, logger, args['OUTPUT_TYPES']).serve(config.serve_host, port)
+
+        elif 'batch' in args and args['batch']:
+            try:
+                with open(args['USERS_FILE']) as users_file:
+                    users = [line.strip() for line in users_file if line.strip()]
+            except EnvironmentError:
+                logger.error('Cannot read users from {0}'.format(args['USERS_FILE']))
+            else:
+                results = run_batch(config, logger, users, args['OUTPUT_TYPES'], args['--refresh'])
+                succeeded = all(results.values())
 
         elif 'make' in args and args['make']:
-            citeproc.start()
-            citeproc.build(args['OUTPUT_TYPES'])
+            # the servers are only started if a section has to be rendered
+            if citeproc.start(args['OUTPUT_TYPES'], lazy=True):
+                succeeded = citeproc.build(args['OUTPUT_TYPES'], args['--force'])
     finally:
         # always try to shutdown the citeproc server
         citeproc.shutdown()
 
+        if profiler is not None:
+            profiler.stop()
+            print_timings(metrics)
+
+        # unattended (e.g. cron) runs can be monitored through their metrics
+        if command is not None and config.metrics_file:
+            write_metrics(metrics, command, succeeded, started)
+
+    # batch runs are unattended, so a user that cannot be built fails the run
+    if 'batch' in args and args['batch'] and not succeeded:
+        sys.exit(1)
+
 
 if __name__ == "__main__":
     arguments = docopt(__doc__, version=app)
@@ -0,0 +1,122 @@
+from collections import deque
+
+
+def _is_word_character(character):
+    # the same definition as \w in Python's re module for str patterns
+    return character.isalnum() or character == '_'
+
+
+class TitleMatcher:
+    def __init__(self, titles):
+        """
+        Compile a list of titles into a single Aho-Corasick automaton
+        :param titles: a list of titles, matched literally, in the order in which they are applied
+        """
+        self.titles = list(titles)
+
+        # each node has a transition table, a failure link and a list of (title index, title length) outputs
+        self._goto = [{}]
+        self._fail = [0]
+        self._outputs = [[]]
+
+        for index, title in enumerate(self.titles):
+            if len(title) == 0:
+                continue
+
+            node = 0
+
+            for character in title:
+                if character not in self._goto[node]:
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._outputs.append([])
+                    self._goto[node][character] = len(self._goto) - 1
+
+                node = self._goto[node][character]
+
+            self._outputs[node].append((index, len(title)))
+
+        # build the failure links breadth-first
+        queue = deque(self._goto[0].values())
+
+        while len(queue) > 0:
+            node = queue.popleft()
+
+            for character, child in self._goto[node].items():
+                queue.append(child)
+
+                fail = self._fail[node]
+                while fail != 0 and character not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                fail = self._goto[fail].get(character, 0)
+                self._fail[child] = fail if fail != child else 0
+                self._outputs[child] = self._outputs[child] + self._outputs[self._fail[child]]
+
+    def find(self, text):
+        """
+        Find every occurrence of every title that is delimited by non-word characters, including overlapping ones
+        :param text: the text to search
+        :return: a list of (start, end, title index) tuples
+        """
+        matches = []
+        node = 0
+
+        for position, character in enumerate(text):
+            while node != 0 and character not in self._goto[node]:
+                node = self._fail[node]
+
+            node = self._goto[node].get(character, 0)
+
+            for index, length in self._outputs[node]:
+                start = position + 1 - length
+                end = position + 1
+
+                if (start == 0 or not _is_word_character(text[start - 1])) and \
+                        (end == len(text) or not _is_word_character(text[end])):
+                    matches.append((start, end, index))
+
+        return matches
+
+    def italicize(self, text):
+        """
+        Wrap titles in <i> tags with the same result as applying each title's replacement in turn: a title found
+        inside an earlier title is nested inside it (e.g. Gravity's Rainbow within The Maximalist Novel...), while a
+        title that would contain or straddle an earlier one is left alone
+        :param text: the text to italicize
+        :return: the italicized text
+        """
+        matches = self.find(text)
+
+        if len(matches) == 0:
+            return text
+
+        # apply the titles in their configured order, left to right
+        matches.sort(key=lambda match: (match[2], match[0]))
+        accepted = []
+
+        for start, end, index in matches:
+            if all(end <= other_start or start >= other_end or (other_start <= start and end <= other_end)
+                   for other_start, other_end in accepted):
+                accepted.append((start, end))
+
+        # closing tags come before opening tags at the same position, and inner titles close before outer ones
+        events = []
+
+        for order, (start, end) in enumerate(accepted):
+            events.append((start, 1, order, '<i>'))
+            events.append((end, 0, -order, '</i>'))
+
+        events.sort()
+
+        output = []
+        position = 0
+
+        for event_position, kind, order, tag in events:
+            output.append(text[position:event_position])
+            output.append(tag)
+            position = event_position
+
+        output.append(text[position:])
+
+        return ''.join(output)
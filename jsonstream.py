@@ -0,0 +1,82 @@
+import json
+
+
+class JsonArrayParser:
+    def __init__(self):
+        """
+        Initialise an incremental parser for a JSON array that returns each element as soon as it is complete
+        """
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        # 'start' expects '[', 'first' expects a value or ']', 'value' expects a value,
+        # 'separator' expects ',' or ']', and 'end' expects nothing more
+        self._state = 'start'
+
+    def feed(self, text):
+        """
+        Parses the next piece of the document
+        :param text: a string continuing the document
+        :return: a list of the array elements completed by this piece
+        :raises ValueError: if the document is not a JSON array
+        """
+        buffer = self._buffer + text
+        position = 0
+        items = []
+
+        while True:
+            # skip whitespace between tokens
+            while position < len(buffer) and buffer[position] in ' \t\n\r\ufeff':
+                position += 1
+
+            if position == len(buffer):
+                break
+
+            if self._state == 'start':
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                self._state = 'first'
+                position += 1
+
+            elif self._state in ('first', 'value'):
+                if self._state == 'first' and buffer[position] == ']':
+                    self._state = 'end'
+                    position += 1
+                    continue
+
+                try:
+                    value, end = self._decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # most likely an element that continues in the next piece
+                    break
+
+                # a number may continue in the next piece (e.g. "12" then "3", or "1.5" then "e3")
+                if isinstance(value, (int, float)) and (end == len(buffer) or buffer[end] in '0123456789+-.eE'):
+                    break
+
+                items.append(value)
+                self._state = 'separator'
+                position = end
+
+            elif self._state == 'separator':
+                if buffer[position] == ',':
+                    self._state = 'value'
+                elif buffer[position] == ']':
+                    self._state = 'end'
+                else:
+                    raise ValueError('Expected "," or "]" at offset {0} of the buffered JSON'.format(position))
+                position += 1
+
+            else:
+                raise ValueError('Unexpected data after the end of the JSON array')
+
+        self._buffer = buffer[position:]
+        return items
+
+    def close(self):
+        """
+        Checks that the document was complete
+        :return: nothing
+        :raises ValueError: if the array was never closed
+        """
+        if self._state != 'end':
+            raise ValueError('Incomplete JSON array')
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+
+def digest_text(text):
+    """
+    Hashes a string
+    :param text: the string
+    :return: a hex digest string
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def digest_value(value):
+    """
+    Hashes a JSON-serialisable value
+    :param value: the value
+    :return: a hex digest string
+    """
+    return digest_text(json.dumps(value, sort_keys=True, default=str))
+
+
+class BuildManifest:
+    def __init__(self, path, logger):
+        """
+        Initialise a manifest of the content hashes of each rule's inputs and output, and of the sections rendered from
+        them, so that a build can skip whatever has not changed since the last one
+        :param path: the manifest file, or None to keep the manifest in memory only
+        :param logger: a logger
+        """
+        self.path = path
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._data = {}
+
+        if path is not None:
+            try:
+                with open(path, 'r') as manifest_file:
+                    self._data = json.load(manifest_file)
+            except (EnvironmentError, ValueError):
+                self._data = {}
+
+        self._data.setdefault('rules', {})
+        self._data.setdefault('digests', {})
+
+    def digest(self, key, signature, compute):
+        """
+        Fetches a content hash that is recomputed only when its source's signature changes
+        :param key: a name for the source (e.g. a path)
+        :param signature: a JSON-serialisable value that changes whenever the source does (e.g. its mtime and size)
+        :param compute: a function that returns the content hash
+        :return: the content hash
+        """
+        signature = json.loads(json.dumps(signature))
+
+        with self._lock:
+            stored = self._data['digests'].get(key)
+
+            if stored is not None and stored[0] == signature:
+                return stored[1]
+
+        value = compute()
+
+        with self._lock:
+            self._data['digests'][key] = [signature, value]
+
+        return value
+
+    def file_digest(self, path):
+        """
+        Hashes the contents of a file
+        :param path: the file
+        :return: a hex digest string or None if the file cannot be read
+        """
+        def compute():
+            with open(path, 'rb') as in_file:
+                return hashlib.sha256(in_file.read()).hexdigest()
+
+        try:
+            stat = os.stat(path)
+            return self.digest('file:' + path, [stat.st_mtime_ns, stat.st_size], compute)
+        except EnvironmentError:
+            return None
+
+    def get(self, rule):
+        """
+        Fetches the record of the last build of a rule
+        :param rule: the rule name
+        :return: a dictionary of 'inputs' (placeholders to hashes), 'sections' (placeholders to rendered sections)
+        and 'output' (the hash of the output), or an empty dictionary if the rule has not been built
+        """
+        with self._lock:
+            return self._data['rules'].get(rule, {})
+
+    def set(self, rule, record):
+        """
+        Records a build of a rule and saves the manifest
+        :param rule: the rule name
+        :param record: the record (see get)
+        :return: nothing
+        """
+        with self._lock:
+            self._data['rules'][rule] = record
+            self._save()
+
+    def save(self):
+        """
+        Saves the manifest
+        :return: nothing
+        """
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+
+        directory = os.path.dirname(self.path) or '.'
+
+        try:
+            # write to a temporary file and rename so that an interrupted build never leaves a partial manifest
+            handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(handle, 'w') as manifest_file:
+                json.dump(self._data, manifest_file)
+            os.replace(temp_path, self.path)
+        except EnvironmentError:
+            self.logger.warning('Cannot write build manifest to {0}'.format(self.path))
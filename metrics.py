@@ -0,0 +1,258 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+# the latency quantiles reported for each series of observations
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+
+# the prefix of every metric name in the Prometheus textfile format
+PROMETHEUS_PREFIX = 'eprints_cv_'
+
+METRICS_FORMATS = ['json', 'prometheus']
+
+
+class _Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.started)
+
+
+def _series_key(name, labels):
+    return name, tuple(sorted((labels or {}).items()))
+
+
+def _quantile(samples, fraction):
+    """
+    Picks a quantile from sorted samples (the nearest rank below, as in dispatcher.PortDispatcher.percentile)
+    :param samples: a sorted list of numbers
+    :param fraction: the quantile as a fraction (e.g. 0.95)
+    :return: the sample
+    """
+    return samples[int(fraction * (len(samples) - 1))]
+
+
+def _prometheus_labels(labels):
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in labels) + '}'
+
+
+def _prometheus_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Initialise a thread-safe collection of the measurements of a run: the time spent in each stage, counters (e.g.
+        citeproc requests), values (e.g. the number of items in a section) and observations (e.g. request latencies)
+        Counters, values and observations are named series, optionally split by a dictionary of labels
+        Stages may nest or overlap (e.g. citeproc round trips made by several threads during a template substitution),
+        so their totals need not add up to the wall time of the run
+        """
+        self._lock = threading.Lock()
+        # stage names to [calls, total seconds], in the order in which stages were first seen
+        self._timings = {}
+        # (name, sorted label pairs) keys to numbers, or to lists of observations
+        self._counters = {}
+        self._values = {}
+        self._observations = {}
+
+    def timer(self, stage):
+        """
+        Times a block of code
+        :param stage: the name of the stage
+        :return: a context manager
+        """
+        return _Timer(self, stage)
+
+    def add_time(self, stage, seconds):
+        """
+        Records time spent in a stage
+        :param stage: the name of the stage
+        :param seconds: the time spent
+        :return: nothing
+        """
+        with self._lock:
+            if stage not in self._timings:
+                self._timings[stage] = [0, 0.0]
+
+            self._timings[stage][0] += 1
+            self._timings[stage][1] += seconds
+
+    def timings(self):
+        """
+        The time spent in each stage
+        :return: a list of (stage, calls, total seconds) tuples in the order in which stages were first seen
+        """
+        with self._lock:
+            return [(stage, calls, seconds) for stage, (calls, seconds) in self._timings.items()]
+
+    def increment(self, name, value=1, labels=None):
+        """
+        Adds to a counter
+        :param name: the name of the counter
+        :param value: the amount to add
+        :param labels: a dictionary of labels that identify the series (e.g. {'port': '8085'})
+        :return: nothing
+        """
+        key = _series_key(name, labels)
+
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def counter(self, name, labels=None):
+        """
+        Reads a counter
+        :param name: the name of the counter
+        :param labels: the labels of the series
+        :return: the value of the counter (0 if it has not been incremented)
+        """
+        with self._lock:
+            return self._counters.get(_series_key(name, labels), 0)
+
+    def set_value(self, name, value, labels=None):
+        """
+        Records a value, replacing any earlier one
+        :param name: the name of the value
+        :param value: the value
+        :param labels: a dictionary of labels that identify the series
+        :return: nothing
+        """
+        with self._lock:
+            self._values[_series_key(name, labels)] = value
+
+    def observe(self, name, value, labels=None):
+        """
+        Records an observation (e.g. a latency), which is summarised by its count, sum and quantiles
+        :param name: the name of the series
+        :param value: the observation
+        :param labels: a dictionary of labels that identify the series
+        :return: nothing
+        """
+        key = _series_key(name, labels)
+
+        with self._lock:
+            if key not in self._observations:
+                self._observations[key] = []
+
+            self._observations[key].append(value)
+
+    def snapshot(self):
+        """
+        Summarises everything recorded so far
+        :return: a dictionary of 'stages', 'counters', 'values' and 'summaries', each a dictionary of names to lists of
+        series (dictionaries with 'labels' and the measurements)
+        """
+        with self._lock:
+            timings = list(self._timings.items())
+            counters = sorted(self._counters.items())
+            values = sorted(self._values.items())
+            observations = sorted((key, sorted(samples)) for key, samples in self._observations.items())
+
+        output = {'stages': {}, 'counters': {}, 'values': {}, 'summaries': {}}
+
+        for stage, (calls, seconds) in timings:
+            output['stages'][stage] = {'calls': calls, 'seconds': seconds}
+
+        for (name, labels), value in counters:
+            output['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+        for (name, labels), value in values:
+            output['values'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+
+        for (name, labels), samples in observations:
+            output['summaries'].setdefault(name, []).append({
+                'labels': dict(labels), 'count': len(samples), 'sum': sum(samples),
+                'quantiles': {str(fraction): _quantile(samples, fraction) for fraction in QUANTILES}})
+
+        return output
+
+    def prometheus(self):
+        """
+        Renders everything recorded so far in the Prometheus text exposition format (for the node exporter's textfile
+        collector)
+        :return: a string
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        if len(snapshot['stages']) > 0:
+            for suffix, field in [('stage_seconds_total', 'seconds'), ('stage_calls_total', 'calls')]:
+                lines.append('# TYPE {0}{1} counter'.format(PROMETHEUS_PREFIX, suffix))
+
+                for stage, timing in snapshot['stages'].items():
+                    lines.append('{0}{1}{2} {3}'.format(PROMETHEUS_PREFIX, suffix,
+                                                        _prometheus_labels([('stage', stage)]),
+                                                        _prometheus_number(timing[field])))
+
+        for kind, metric_type in [('counters', 'counter'), ('values', 'gauge')]:
+            for name, series in snapshot[kind].items():
+                lines.append('# TYPE {0}{1} {2}'.format(PROMETHEUS_PREFIX, name, metric_type))
+
+                for entry in series:
+                    lines.append('{0}{1}{2} {3}'.format(PROMETHEUS_PREFIX, name,
+                                                        _prometheus_labels(sorted(entry['labels'].items())),
+                                                        _prometheus_number(entry['value'])))
+
+        for name, series in snapshot['summaries'].items():
+            lines.append('# TYPE {0}{1} summary'.format(PROMETHEUS_PREFIX, name))
+
+            for entry in series:
+                labels = sorted(entry['labels'].items())
+
+                for fraction, value in entry['quantiles'].items():
+                    lines.append('{0}{1}{2} {3}'.format(PROMETHEUS_PREFIX, name,
+                                                        _prometheus_labels(labels + [('quantile', fraction)]),
+                                                        _prometheus_number(value)))
+
+                lines.append('{0}{1}_sum{2} {3}'.format(PROMETHEUS_PREFIX, name, _prometheus_labels(labels),
+                                                        _prometheus_number(entry['sum'])))
+                lines.append('{0}{1}_count{2} {3}'.format(PROMETHEUS_PREFIX, name, _prometheus_labels(labels),
+                                                          entry['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, metrics_format):
+        """
+        Writes everything recorded so far to a file, replacing it atomically so that collectors never read a partial
+        file
+        :param path: the destination
+        :param metrics_format: 'json' or 'prometheus'
+        :return: nothing
+        :raises ValueError: if the format is not recognised
+        :raises EnvironmentError: if the file cannot be written
+        """
+        if metrics_format == 'json':
+            content = json.dumps(self.snapshot(), indent=2) + '\n'
+        elif metrics_format == 'prometheus':
+            content = self.prometheus()
+        else:
+            raise ValueError('Unknown metrics format {0} (expected one of {1})'.format(
+                metrics_format, ', '.join(METRICS_FORMATS)))
+
+        directory = os.path.dirname(path) or '.'
+        os.makedirs(directory, exist_ok=True)
+
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+
+        try:
+            with os.fdopen(handle, 'w') as metrics_file:
+                metrics_file.write(content)
+            os.replace(temp_path, path)
+        except EnvironmentError:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
+            raise
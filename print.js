@@ -1,9 +1,24 @@
 const htmlPdf = require('html-pdf-chrome');
 
+// usage: nodejs ./print.js [url] [output file] [timeout in ms]
+// the page sets window.htmlPdfDone once paged.js has finished laying it out (see templates/PDF)
+const url = process.argv[2] || 'http://127.0.0.1:8000/output/Eve-CV-PDF.html';
+const output = process.argv[3] || './output/Eve-CV.pdf';
+const timeout = parseInt(process.argv[4] || '60000', 10);
+
 const options = {
-    completionTrigger: new htmlPdf.CompletionTrigger.Timer(5000),
+    completionTrigger: new htmlPdf.CompletionTrigger.Variable('htmlPdfDone', timeout),
     chromeFlags: ['--disable-web-security', '--headless']
 };
 
-const url = 'http://127.0.0.1:8000/output/Eve-CV-PDF.html';
-let pdf = htmlPdf.create(url, options).then((pdf) => pdf.toFile('./output/Eve-CV.pdf'));
+const started = Date.now();
+
+htmlPdf.create(url, options)
+    .then((pdf) => pdf.toFile(output))
+    .then(() => {
+        console.log('Printed ' + output + ' in ' + (Date.now() - started) + 'ms');
+    })
+    .catch((error) => {
+        console.error('Cannot print ' + url + ': ' + error);
+        process.exit(1);
+    });
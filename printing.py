@@ -0,0 +1,87 @@
+import functools
+import os
+import shlex
+import subprocess
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote
+
+# a step in an output rule that starts with this prints the rule's output to the PDF file that follows it
+PRINT_STEP = 'print:'
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class StaticServer:
+    def __init__(self, directory, logger):
+        """
+        Initialise an in-process static file server on an ephemeral port, for use as a context manager
+        :param directory: the directory to serve
+        :param logger: a logger
+        """
+        self.directory = directory
+        self.logger = logger
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def url(self, path):
+        """
+        Builds the URL of a file under the served directory
+        :param path: the file
+        :return: a URL string
+        """
+        relative = os.path.relpath(os.path.abspath(path), os.path.abspath(self.directory))
+        return 'http://127.0.0.1:{0}/{1}'.format(self.port, quote(relative.replace(os.sep, '/')))
+
+    def __enter__(self):
+        handler = functools.partial(_QuietHandler, directory=self.directory)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+        self.logger.debug('Serving {0} on port {1}'.format(self.directory, self.port))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+
+def print_pdf(config, logger, html_file, pdf_file):
+    """
+    Prints an HTML document to PDF with print.js, serving it (and the static files it refers to) from this process
+    print.js returns once the document signals that its layout is complete, rather than after a fixed delay
+    :param config: a configuration
+    :param logger: a logger
+    :param html_file: the HTML document
+    :param pdf_file: the PDF destination
+    :return: True if successful, otherwise False
+    """
+    with StaticServer(os.getcwd(), logger) as server:
+        command = shlex.split(config.print_command) + [server.url(html_file), pdf_file,
+                                                       str(int(config.print_timeout * 1000))]
+
+        logger.debug("Printing {0} to {1}".format(html_file, pdf_file))
+        started = time.monotonic()
+
+        try:
+            result = subprocess.call(command, timeout=config.print_timeout + 30)
+        except (EnvironmentError, subprocess.TimeoutExpired) as exc:
+            logger.error('Cannot print {0}: {1}'.format(html_file, exc))
+            return False
+
+    if result != 0:
+        logger.error('Printing {0} failed with exit code {1}'.format(html_file, result))
+        return False
+
+    logger.debug("Printed {0} in {1:.2f}s".format(pdf_file, time.monotonic() - started))
+    return True
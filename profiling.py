@@ -0,0 +1,103 @@
+import functools
+import os
+
+
+def _save(yappi, path):
+    """
+    Saves the function statistics collected so far in callgrind and pstats formats
+    :param yappi: the yappi module
+    :param path: the path of the output files, without an extension
+    :return: a list of the files written
+    """
+    stats = yappi.get_func_stats()
+    stats.save(path + '.callgrind', type='callgrind')
+    stats.save(path + '.pstats', type='pstat')
+
+    return [path + '.callgrind', path + '.pstats']
+
+
+def _profiled_call(path, function, *args):
+    """
+    Calls a function in a worker process under the profiler, saving the process's statistics (which accumulate across
+    calls) next to those of the main process
+    :param path: the path of the main process's output files, without an extension
+    :param function: the function to call
+    :param args: the arguments to the function
+    :return: the result of the function
+    """
+    import yappi
+
+    if not yappi.is_running():
+        yappi.set_clock_type('wall')
+        yappi.start(profile_threads=True)
+
+    try:
+        return function(*args)
+    finally:
+        _save(yappi, '{0}.{1}'.format(path, os.getpid()))
+
+
+class Profiler:
+    def __init__(self, directory, name, logger):
+        """
+        Initialise a wall-clock profiler for a run, covering every thread and, through wrap, worker processes
+        :param directory: the directory for the callgrind and pstats output
+        :param name: the name of the run (used to name the output files)
+        :param logger: a logger
+        """
+        self.directory = directory
+        self.name = name
+        self.logger = logger
+        self._yappi = None
+
+    @property
+    def path(self):
+        return os.path.abspath(os.path.join(self.directory, self.name))
+
+    def start(self):
+        """
+        Starts profiling
+        :return: True if the profiler started, otherwise False
+        """
+        try:
+            import yappi
+        except ImportError:
+            self.logger.error('Cannot profile: yappi is not installed')
+            return False
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        yappi.set_clock_type('wall')
+        yappi.start(profile_threads=True)
+        self._yappi = yappi
+
+        return True
+
+    def stop(self):
+        """
+        Stops profiling and writes the output
+        :return: nothing
+        """
+        if self._yappi is None:
+            return
+
+        self._yappi.stop()
+
+        try:
+            for path in _save(self._yappi, self.path):
+                self.logger.info('Wrote profile to {0}'.format(path))
+        except EnvironmentError as exc:
+            self.logger.error('Cannot write profile: {0}'.format(exc))
+
+        self._yappi = None
+
+    def wrap(self, function):
+        """
+        Wraps a function that will run in a worker process so that the worker is profiled too
+        :param function: a module-level function
+        :return: a picklable callable
+        """
+        if self._yappi is None:
+            return function
+
+        return functools.partial(_profiled_call, self.path, function)
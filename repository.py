@@ -1,41 +1,137 @@
+import codecs
+import hashlib
+import itertools
 import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 import requests
 import json
 
+from jsonstream import JsonArrayParser
+from metrics import Metrics
+from store import STORES, export_jsonl
+
+
+def _classify_chunk(table, review_of, items):
+    """
+    Looks up the output types for a chunk of items in a classification table (a module-level function so that it can
+    run in a process pool)
+    :param table: the classification table
+    :param review_of: the text that starts a review
+    :param items: a list of eprints items
+    :return: a list of tuples of output types (or None for items of an unhandled type), one per item
+    """
+    output = []
+
+    for item in items:
+        refereed = item['refereed'] if item.get('refereed') in ('TRUE', 'FALSE') else None
+        output.append(table.get((item['type'], refereed, 'editors' in item, item['title'].startswith(review_of))))
+
+    return output
+
+
+def _chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most size elements
+    :param iterable: the iterable
+    :param size: the chunk size
+    :return: a generator of lists
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
 
 class Repository:
-    def __init__(self, config, logger, refresh):
+    def __init__(self, config, logger, refresh, metrics=None):
         """
         Initialise a repository
         :param config: a configuration
         :param logger: a logger
         :param refresh: whether fetch operations should hit the remote endpoint even if there is an on-disk copy
+        :param metrics: the Metrics in which to record the time spent in each stage (a new one if None)
         """
         self.config = config
         self.logger = logger
         self.url = self._build_repo_url()
-        self.json = None
+        self._chunks = None
         self._json_loaded = False
         self.refresh = refresh
         self._type_safe = False
+        self._classification_table = None
+        self._not_modified = False
+        self._source_hash = None
+        # the response whose body has been downloaded to storage['json'] + '.part' but not yet parsed
+        self._downloaded = None
+        self.store = STORES[config.storage_backend](config, logger)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # a profiling.Profiler, if the run is being profiled, so that worker processes are profiled too
+        self.profiler = None
+
+        # parsed sections keyed by name, each stored with the store signature it was read from
+        self._sections = {}
+        self._sections_lock = threading.Lock()
 
     def __getattr__(self, name):
         """
         A generic getter for undefined attributes that we use to return types (e.g. repo.book_sections)
+        Items are returned as shallow copies of the cached section, so callers may set keys on them freely
         :param name: the name of the attr
         """
+        # private attributes are never sections (this also stops lookups recursing before __init__ has run)
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        items = self._load_section(name)
+
+        if items is None:
+            return None
+
+        return [dict(item) for item in items]
+
+    def _load_section(self, name):
+        """
+        Loads a section from the store, or from memory if the store has not changed since it was last read
+        :param name: the name of the section
+        :return: a list of items or None if the operation fails
+        """
         try:
-            with open(self.config.storage[name], "r") as json_in_file:
-                data = json_in_file.readlines()
-                output = []
-                for line in data:
-                    output.append(json.loads(line))
-                return output
-        except EnvironmentError:
-            self.logger.error('Cannot load json from {0}'.format(self.config.storage[name]))
+            signature = self.store.signature(name)
+
+            with self._sections_lock:
+                if name in self._sections and self._sections[name][0] == signature:
+                    return self._sections[name][1]
+
+            output = self.store.read(name)
+        except EnvironmentError as exc:
+            self.logger.error('Cannot load {0} from the data store: {1}'.format(name, exc))
             return None
 
+        with self._sections_lock:
+            self._sections[name] = (signature, output)
+
+        return output
+
+    def invalidate(self, name=None):
+        """
+        Drops sections from the in-memory cache so that they are re-read from disk
+        :param name: the name of the section to drop, or None to drop all sections
+        :return: nothing
+        """
+        with self._sections_lock:
+            if name is None:
+                self._sections = {}
+            else:
+                self._sections.pop(name, None)
+
     def _build_repo_url(self):
         """
         Creates the eprints endpoint URL
@@ -59,50 +155,195 @@ class Repository:
 
     def _populate_json(self, refresh):
         """
-        Updates the internal json object either from the on-disk file or from the remote repo
+        Opens the eprints data as a stream either from the on-disk file or from the remote repo
         :param refresh: whether to refresh the remote repository even if there is an on-disk representation
         :return: boolean indicating whether the operation succeeded
         """
 
+        self._not_modified = False
+
         # determine whether to refresh the JSON
         if not os.path.isfile(self.config.storage["json"]) or refresh:
             self.logger.debug("Attempting to refresh {0}".format(self.url))
 
             try:
-                # download the JSON
-                data = requests.get(self.url, verify=False).text
+                # download the JSON, unless it has not changed since we last did
+                response = requests.get(self.url, verify=False, headers=self._conditional_headers(), stream=True)
             except requests.RequestException as exc:
                 self.logger.error("Error fetching eprints data: {0}".format(exc))
                 self._json_loaded = False
                 return False
 
+            self.metrics.increment('eprints_responses_total', labels={'status': str(response.status_code)})
+
+            if response.status_code == 304:
+                self.logger.info("eprints data has not changed since the last refresh")
+                response.close()
+                self._not_modified = True
+                return True
+
             try:
-                # write the JSON to the output file
-                with open(self.config.storage["json"], "w") as json_out_file:
-                    json_out_file.write(data)
-                    self.json = json.loads(data)
-                    self._json_loaded = True
-                    return True
-            except EnvironmentError:
-                self.logger.error('Cannot write json data to {0}'.format(self.config.storage["json"]))
-                # try to delete the file
-                os.remove(self.config.storage["json"])
+                response.raise_for_status()
+            except requests.HTTPError as exc:
+                self.logger.error("Error fetching eprints data: {0}".format(exc))
+                response.close()
                 self._json_loaded = False
                 return False
+
+            # the body is written to disk as it is parsed
+            self._chunks = self._download_chunks(response)
+            self._json_loaded = True
+            return True
         else:
             # load the JSON from the disk instead
             self.logger.debug("Attempting to load JSON from data store {0}".format(self.config.storage["json"]))
-            try:
-                with open(self.config.storage["json"], "r") as json_in_file:
-                    data = json_in_file.read()
-                    self.json = json.loads(data)
-                    self._json_loaded = True
-                    return True
-            except EnvironmentError:
+            if not os.access(self.config.storage["json"], os.R_OK):
                 self.logger.error('Cannot load json from {0}'.format(self.config.storage["json"]))
                 self._json_loaded = False
                 return False
 
+            self._chunks = self._file_chunks(self.config.storage["json"])
+            self._json_loaded = True
+            return True
+
+    def _download_chunks(self, response):
+        """
+        Yields the body of a response in chunks while writing it to a partial copy of the eprints data
+        The on-disk copy (and its validators) are only replaced by _keep_download once the body has been parsed and
+        stored
+        :param response: a streamed response from eprints
+        :return: a generator of byte strings
+        """
+        temp_path = self.config.storage["json"] + '.part'
+        complete = False
+        self._downloaded = None
+
+        try:
+            with open(temp_path, "wb") as json_out_file:
+                chunks = response.iter_content(chunk_size=self.config.stream_chunk_size)
+
+                while True:
+                    # only the time spent waiting on the network, not that spent by the consumer of each chunk
+                    with self.metrics.timer('export download'):
+                        chunk = next(chunks, None)
+
+                    if chunk is None:
+                        break
+
+                    self.metrics.increment('eprints_downloaded_bytes_total', len(chunk))
+                    json_out_file.write(chunk)
+                    yield chunk
+
+            complete = True
+            self._downloaded = response
+        finally:
+            response.close()
+            if not complete and os.path.isfile(temp_path):
+                os.remove(temp_path)
+
+    def _keep_download(self, keep):
+        """
+        Replaces the on-disk copy of the eprints data (and its validators) with a completed download, or discards it
+        :param keep: whether the download was parsed and stored successfully
+        :return: nothing
+        """
+        temp_path = self.config.storage["json"] + '.part'
+        response = self._downloaded
+        self._downloaded = None
+
+        if not os.path.isfile(temp_path):
+            return
+
+        try:
+            if keep and response is not None:
+                os.replace(temp_path, self.config.storage["json"])
+                self._save_validators(response)
+            else:
+                os.remove(temp_path)
+        except EnvironmentError as exc:
+            self.logger.warning('Cannot replace {0}: {1}'.format(self.config.storage["json"], exc))
+
+    def _file_chunks(self, path):
+        """
+        Yields a file in chunks
+        :param path: the file to read
+        :return: a generator of byte strings
+        """
+        with open(path, "rb") as json_in_file:
+            while True:
+                chunk = json_in_file.read(self.config.stream_chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _iter_items(self):
+        """
+        Parses the opened eprints data incrementally, hashing it as it goes
+        :return: a generator of eprints items
+        """
+        parser = JsonArrayParser()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        self._source_hash = hashlib.sha256()
+
+        for chunk in self._chunks:
+            with self.metrics.timer('parsing'):
+                self._source_hash.update(chunk)
+                items = parser.feed(decoder.decode(chunk))
+
+            for item in items:
+                yield item
+
+        with self.metrics.timer('parsing'):
+            items = parser.feed(decoder.decode(b'', final=True))
+
+        for item in items:
+            yield item
+
+        parser.close()
+
+    def _conditional_headers(self):
+        """
+        Builds conditional request headers from the validators saved with the on-disk copy of the eprints data
+        :return: a dictionary of headers (empty if there is no on-disk copy or no saved validators)
+        """
+        headers = {}
+
+        if not os.path.isfile(self.config.storage["json"]):
+            return headers
+
+        try:
+            with open(self.config.storage["json_validators"], "r") as validators_file:
+                validators = json.load(validators_file)
+        except (EnvironmentError, ValueError):
+            return headers
+
+        # validators are only meaningful for the URL that issued them
+        if validators.get('url') != self.url:
+            return headers
+
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        return headers
+
+    def _save_validators(self, response):
+        """
+        Saves the ETag and Last-Modified validators of a response alongside the on-disk copy of the eprints data
+        :param response: the response from eprints
+        :return: nothing
+        """
+        validators = {'url': self.url,
+                      'etag': response.headers.get('ETag'),
+                      'last_modified': response.headers.get('Last-Modified')}
+
+        try:
+            with open(self.config.storage["json_validators"], "w") as validators_file:
+                json.dump(validators, validators_file)
+        except EnvironmentError:
+            self.logger.warning('Cannot write validators to {0}'.format(self.config.storage["json_validators"]))
+
     def _parse_json(self, types, load_json=False, check_types=False):
         """
         Parse JSON from eprints into sections
@@ -117,163 +358,193 @@ class Repository:
         if not self._parse_prechecks(check_types, load_json, types):
             return False
 
-        # build a dictionary of output types with items in them
-        self.logger.debug("Building output list")
-        outputs = self._build_output_types_list()
+        # stream the items straight into classification and the section files
+        self.logger.debug("Writing sections")
 
-        return self._write_sections_to_disk(outputs)
+        written = False
 
-    def _write_sections_to_disk(self, outputs):
-        """
-        Writes the outputs to the disk for fast access
-        :param outputs: the outputs to write
-        :return: True if success, otherwise False
-        """
-        for output_type, output_list in outputs.items():
-            self.logger.debug("Writing {0} to {1}".format(output_type, self.config.storage[output_type]))
-            try:
-                # write the JSON to the output file
-                with open(self.config.storage[output_type], "w") as json_out_file:
-                    for output in output_list:
-                        json_out_file.write(json.dumps(output) + '\n')
-            except EnvironmentError:
-                self.logger.error('Cannot write json data to {0}'.format(self.config.storage["json"]))
-                # try to delete the file
-                os.remove(self.config.storage[output_type])
-                self._json_loaded = False
-                return False
-        return True
+        try:
+            written = self._write_sections_to_disk(self._iter_items())
+        except requests.RequestException as exc:
+            self.logger.error("Error fetching eprints data: {0}".format(exc))
+        except ValueError as exc:
+            self.logger.error("Error parsing eprints data: {0}".format(exc))
+        finally:
+            # a download only replaces the on-disk copy once it has been parsed into the data store
+            self._keep_download(written)
+
+        # the stream has been consumed, so it will need to be opened again for another pass
+        self._json_loaded = False
+        return written
 
-    def _build_output_types_list(self):
+    def _write_sections_to_disk(self, items):
         """
-        Build a dictionary of output types with corresponding outputs within
-        :return: a dictionary of output types as keys with corresponding outputs within
+        Classifies items and writes them to the data store for fast access
+        The store is only updated once all items are written
+        :param items: an iterable of eprints items
+        :return: True if success, otherwise False
         """
-        outputs = {}
+        writer = None
+        completed = False
+        item_count = 0
+        unhandled_count = 0
+        section_counts = {}
 
-        eprints_db_vals = list(self.config.eprints_db.values())
+        try:
+            writer = self.store.writer()
 
-        for item in self.json:
-            if item['type'] in eprints_db_vals:
-                # this is an item that we need to handle
+            for chunk, chunk_types in self._classify(_chunked(items, self.config.classification_chunk_size)):
+                item_count += len(chunk)
 
-                # do a naughty reverse dictionary lookup of all types that correspond
-                potential_types = self._get_potential_types(item)
+                with self.metrics.timer('section writes'):
+                    for item, item_types in zip(chunk, chunk_types):
+                        if item_types is None:
+                            self.logger.debug("Unsure how to handle type {0} for item {1}".format(item['type'],
+                                                                                                   item['title']))
+                            unhandled_count += 1
+                            continue
 
-                # reduce the types according to the allowed peer review criteria
-                potential_types = self._filter_by_peer_review(item, potential_types)
+                        writer.add(item, item_types)
 
-                # reduce the types according to the allowed edited criteria
-                potential_types = self._filter_by_editorial(item, potential_types)
+                        for item_type in item_types:
+                            section_counts[item_type] = section_counts.get(item_type, 0) + 1
 
-                # reduce the types according to the allowed book review criteria
-                potential_types = self._filter_by_book_review(item, potential_types)
+            with self.metrics.timer('section writes'):
+                writer.commit(self._source_hash.hexdigest() if self._source_hash is not None else None)
+            self.invalidate()
 
-                # we now have a list of types to add to the output dictionary
-                for remaining_type in potential_types:
-                    if remaining_type not in outputs:
-                        self.logger.debug("Adding type {0} to outputs for the first time".format(remaining_type))
-                        outputs[remaining_type] = []
+            self.metrics.set_value('eprints_items', item_count)
+            self.metrics.set_value('eprints_unhandled_items', unhandled_count)
 
-                    outputs[remaining_type].append(item)
-            else:
-                self.logger.debug("Unsure how to handle type {0} for item {1}".format(item['type'], item['title']))
+            for section, count in section_counts.items():
+                self.metrics.set_value('eprints_section_items', count, {'section': section})
 
-        return outputs
+            completed = True
+            return True
+        except (EnvironmentError, sqlite3.Error) as exc:
+            self.logger.error('Cannot write json data: {0}'.format(exc))
+            self._json_loaded = False
+            return False
+        finally:
+            if not completed and writer is not None:
+                # try to delete the partial data
+                writer.abort()
 
-    def _filter_by_book_review(self, item, potential_types):
+    def _classify(self, chunks):
         """
-        Reduces an item type list by its book review criteria
-        :param item: the item
-        :param potential_types: a list of potential types for the item
-        :return: a list of filtered potential types
+        Looks up the output types for chunks of items, across a process pool if configured
+        :param chunks: an iterable of lists of eprints items
+        :return: a generator of (chunk, list of tuples of output types or None for an unhandled type) pairs
         """
-        filtered_types = []
+        table = self._get_classification_table()
 
-        for potential_type in potential_types:
-            # determine whether the potential type matches the review criteria
-            if self.config.book_review[potential_type] == 'ANY':
-                # this type allows both book review and non-book-review items
-                filtered_types.append(potential_type)
+        if self.config.classification_workers <= 1:
+            for chunk in chunks:
+                with self.metrics.timer('classification'):
+                    chunk_types = _classify_chunk(table, self.config.review_of, chunk)
 
-            elif self.config.book_review[potential_type] and item['title'].startswith(self.config.review_of):
-                # this type allows only book reviews
-                filtered_types.append(potential_type)
+                yield chunk, chunk_types
+            return
 
-            elif not self.config.book_review[potential_type] and \
-                    item['title'].startswith(self.config.review_of) is False:
-                # this type allows only non-book-reviews
-                filtered_types.append(potential_type)
+        self.logger.debug("Classifying items across {0} processes".format(self.config.classification_workers))
+        classify_chunk = _classify_chunk if self.profiler is None else self.profiler.wrap(_classify_chunk)
 
-        self.logger.debug("Reduced types for {0} to {1} [book review filter]".format(item['title'], filtered_types))
-        return filtered_types
+        with ProcessPoolExecutor(max_workers=self.config.classification_workers) as executor:
+            # keep a bounded window of chunks in flight so that memory use does not grow with the export
+            pending = deque()
 
-    def _filter_by_editorial(self, item, potential_types):
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(classify_chunk, table, self.config.review_of, chunk)))
+
+                if len(pending) > self.config.classification_workers * 2:
+                    chunk, future = pending.popleft()
+
+                    # the time spent waiting on the workers, as the classification itself overlaps the parsing
+                    with self.metrics.timer('classification'):
+                        chunk_types = future.result()
+
+                    yield chunk, chunk_types
+
+            while len(pending) > 0:
+                chunk, future = pending.popleft()
+
+                with self.metrics.timer('classification'):
+                    chunk_types = future.result()
+
+                yield chunk, chunk_types
+
+    def _get_classification_table(self):
         """
-        Reduces an item type list by its editorial criteria
-        :param item: the item
-        :param potential_types: a list of potential types for the item
-        :return: a list of filtered potential types
+        Precomputes the output types for every combination of the criteria on which items are classified
+        :return: a dictionary of (eprints type, refereed, has editors, is review) keys to tuples of output types
         """
-        filtered_types = []
+        if self._classification_table is not None:
+            return self._classification_table
 
-        for potential_type in potential_types:
-            # determine whether the potential type matches the editorial criteria
-            if self.config.editorial[potential_type] == 'ANY':
-                # this type allows both edited and non-edited items
-                filtered_types.append(potential_type)
+        table = {}
 
-            elif self.config.editorial[potential_type] and 'editors' in item:
-                # this type allows only edited items
-                filtered_types.append(potential_type)
+        for eprints_type in set(self.config.eprints_db.values()):
+            for refereed in ['TRUE', 'FALSE', None]:
+                for has_editors in [True, False]:
+                    for is_review in [True, False]:
+                        # a reverse lookup of all output types that correspond, reduced by the criteria
+                        table[(eprints_type, refereed, has_editors, is_review)] = tuple(
+                            output_type for output_type, db_type in self.config.eprints_db.items()
+                            if db_type == eprints_type and
+                            self._matches_peer_review(output_type, refereed) and
+                            self._matches_editorial(output_type, has_editors) and
+                            self._matches_book_review(output_type, is_review))
 
-            elif not self.config.editorial[potential_type] and 'editors' not in item:
-                # this type allows only non-edited items
-                filtered_types.append(potential_type)
+        self.logger.debug("Built classification table with {0} entries".format(len(table)))
+        self._classification_table = table
 
-        self.logger.debug("Reduced types for {0} to {1} [editorial filter]".format(item['title'], filtered_types))
-        return filtered_types
+        return table
 
-    def _filter_by_peer_review(self, item, potential_types):
+    def _matches_book_review(self, output_type, is_review):
         """
-        Reduces an item type list by its peer-review criteria
-        :param item: the item
-        :param potential_types: a list of potential types for the item
-        :return: a list of filtered potential types
+        Determines whether an output type accepts an item by its book review criteria
+        :param output_type: the output type
+        :param is_review: whether the item's title starts with config.review_of
+        :return: True if the item is accepted, otherwise False
         """
-        filtered_types = []
-
-        for potential_type in potential_types:
-            # determine whether the potential type matches the review criteria
-            if self.config.peer_reviewed[potential_type] == 'ANY':
-                # this type allows both peer-reviewed and non-peer-reviewed items
-                filtered_types.append(potential_type)
+        if self.config.book_review[output_type] == 'ANY':
+            # this type allows both book review and non-book-review items
+            return True
 
-            elif self.config.peer_reviewed[potential_type] and 'refereed' in item and item['refereed'] == 'TRUE':
-                # this type allows only peer-reviewed items
-                filtered_types.append(potential_type)
+        # this type allows only book reviews, or only non-book-reviews
+        return bool(self.config.book_review[output_type]) == is_review
 
-            elif not self.config.peer_reviewed[potential_type] and 'refereed' in item and item['refereed'] == 'FALSE':
-                # this type allows only non-peer-reviewed items
-                filtered_types.append(potential_type)
+    def _matches_editorial(self, output_type, has_editors):
+        """
+        Determines whether an output type accepts an item by its editorial criteria
+        :param output_type: the output type
+        :param has_editors: whether the item has editors
+        :return: True if the item is accepted, otherwise False
+        """
+        if self.config.editorial[output_type] == 'ANY':
+            # this type allows both edited and non-edited items
+            return True
 
-        self.logger.debug("Reduced types for {0} to {1} [peer review filter]".format(item['title'], filtered_types))
-        return filtered_types
+        # this type allows only edited items, or only non-edited items
+        return bool(self.config.editorial[output_type]) == has_editors
 
-    def _get_potential_types(self, item):
+    def _matches_peer_review(self, output_type, refereed):
         """
-        Builds a list of potential sub-types for an item, which can then be matched against for peer review criteria
-        :param item: the JSON item from eprints
-        :return: a list of potential sub-types for the item
+        Determines whether an output type accepts an item by its peer-review criteria
+        :param output_type: the output type
+        :param refereed: the item's refereed value ('TRUE', 'FALSE' or None if it has neither)
+        :return: True if the item is accepted, otherwise False
         """
-        sub_types = []
+        if self.config.peer_reviewed[output_type] == 'ANY':
+            # this type allows both peer-reviewed and non-peer-reviewed items
+            return True
 
-        for key, val in self.config.eprints_db.items():
-            if val == item['type']:
-                sub_types.append(key)
+        if self.config.peer_reviewed[output_type]:
+            # this type allows only peer-reviewed items
+            return refereed == 'TRUE'
 
-        self.logger.debug("Potential sub-types for item {0} are {1}".format(item['title'], sub_types))
-        return sub_types
+        # this type allows only non-peer-reviewed items
+        return refereed == 'FALSE'
 
     def _parse_prechecks(self, check_types, load_json, types):
         """
@@ -341,6 +612,23 @@ class Repository:
             self._type_safe = True
             return True
 
+    def export(self, types):
+        """
+        Writes sections from the data store to their JSON-lines files (config.storage)
+        :param types: A list of types to export
+        :return: True if successful, otherwise False
+        """
+        if not self._check_types(types):
+            return False
+
+        try:
+            export_jsonl(self.store, self.config, self.logger, types)
+        except EnvironmentError as exc:
+            self.logger.error('Cannot export json data: {0}'.format(exc))
+            return False
+
+        return True
+
     def fetch(self, types):
         """
         Fetches data from the repository and prepares the on-disk structure
@@ -355,6 +643,17 @@ class Repository:
         if not self._populate_json(self.refresh):
             return False
 
+        if self._not_modified:
+            # nothing has changed remotely, so the sections on disk are current if they are all there
+            if self.store.has_sections(types):
+                self.logger.info("Sections are up to date")
+                return True
+
+            if not self._populate_json(False):
+                return False
+
         # attempt to parse the requested sections
         if not self._parse_json(types):
             return False
+
+        return True
@@ -0,0 +1,105 @@
+import os
+import threading
+
+
+class SectionRegistry:
+    def __init__(self, directory, logger):
+        """
+        Initialise a registry of the static sections (e.g. sections/Teaching), which are read once and then served
+        from memory until their files change
+        :param directory: the directory of sections
+        :param logger: a logger
+        """
+        self.directory = directory
+        self.logger = logger
+        self._sections = {}
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _read(self, name):
+        """
+        Reads a section from disk
+        :param name: the name of the section
+        :return: a (signature, content) tuple
+        :raises EnvironmentError: if the section cannot be read
+        """
+        path = os.path.join(self.directory, name)
+        stat = os.stat(path)
+
+        with open(path) as f:
+            content = '\n'.join(line.rstrip('\n') for line in f)
+
+        return (stat.st_mtime_ns, stat.st_size), content
+
+    def load(self):
+        """
+        Reads every section in the directory
+        :return: nothing
+        """
+        sections = {}
+
+        try:
+            names = [entry.name for entry in os.scandir(self.directory) if entry.is_file()]
+        except EnvironmentError:
+            self.logger.warning('Cannot list sections in {0}'.format(self.directory))
+            names = []
+
+        for name in names:
+            try:
+                sections[name] = self._read(name)
+            except EnvironmentError:
+                self.logger.warning('Cannot load section {0}'.format(name))
+
+        with self._lock:
+            self._sections = sections
+            self._loaded = True
+
+        self.logger.debug('Loaded {0} sections from {1}'.format(len(sections), self.directory))
+
+    def _ensure_loaded(self):
+        with self._lock:
+            loaded = self._loaded
+
+        if not loaded:
+            self.load()
+
+    def __contains__(self, name):
+        self._ensure_loaded()
+
+        with self._lock:
+            if name in self._sections:
+                return True
+
+        # a section added since the directory was loaded
+        return os.path.isfile(os.path.join(self.directory, name))
+
+    def missing(self, names):
+        """
+        Finds the names that do not correspond to a section
+        :param names: a list of section names
+        :return: a list of the missing names
+        """
+        return [name for name in names if name not in self]
+
+    def get(self, name):
+        """
+        Fetches a section, rereading it only if its file has changed
+        :param name: the name of the section
+        :return: the content of the section
+        :raises EnvironmentError: if the section cannot be read
+        """
+        self._ensure_loaded()
+
+        path = os.path.join(self.directory, name)
+        stat = os.stat(path)
+
+        with self._lock:
+            if name in self._sections and self._sections[name][0] == (stat.st_mtime_ns, stat.st_size):
+                return self._sections[name][1]
+
+        signature, content = self._read(name)
+
+        with self._lock:
+            self._sections[name] = (signature, content)
+
+        return content
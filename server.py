@@ -0,0 +1,202 @@
+import hashlib
+import mimetypes
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+
+class RenderedDocument:
+    def __init__(self, digest, body, content_type):
+        """
+        Initialise a rendered output document
+        :param digest: the hash of the rule's inputs that the document was rendered from
+        :param body: the document as bytes
+        :param content_type: the MIME type of the document
+        """
+        self.digest = digest
+        self.body = body
+        self.content_type = content_type
+        self.etag = '"{0}"'.format(hashlib.sha256(body).hexdigest()[0:32])
+
+
+class CVService:
+    def __init__(self, citeproc, config, logger, rules):
+        """
+        Initialise a service that renders rules on request through CiteProc.build and keeps the results in memory,
+        keyed by the hashes of their inputs
+        :param citeproc: a CiteProc
+        :param config: a configuration
+        :param logger: a logger
+        :param rules: the rules that may be requested (the first is served at /)
+        """
+        self.citeproc = citeproc
+        self.config = config
+        self.logger = logger
+        self.rules = list(rules)
+
+        self._documents = {}
+        self._lock = threading.Lock()
+        # builds share the CiteProc's per-build state (e.g. the pending external sections and shared responses), so
+        # only one rule is rendered at a time
+        self._render_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def document(self, rule):
+        """
+        Fetches the rendered document for a rule, rendering it first if its inputs have changed
+        :param rule: the rule name
+        :return: a RenderedDocument, or None if the rule cannot be rendered
+        """
+        digest = self.citeproc.input_digest(rule)
+
+        with self._lock:
+            document = self._documents.get(rule)
+
+        if document is not None and document.digest == digest:
+            return document
+
+        # requests that arrive during a render wait and then share its result
+        with self._render_lock:
+            with self._lock:
+                document = self._documents.get(rule)
+
+            if document is not None and document.digest == digest:
+                return document
+
+            return self._render(rule, digest) or document
+
+    def _render(self, rule, digest):
+        """
+        Renders a rule and caches the result
+        :param rule: the rule name
+        :param digest: the hash of the rule's inputs
+        :return: a RenderedDocument, or None if the rule cannot be rendered
+        """
+        self.logger.info("Rendering {0}".format(rule))
+
+        try:
+            built = self.citeproc.build([rule])
+        except (EnvironmentError, ValueError, requests.RequestException) as exc:
+            self.logger.error("Cannot render {0}: {1}".format(rule, exc))
+            return None
+
+        if not built:
+            self.logger.error("Cannot render {0}".format(rule))
+            return None
+
+        output_file = self.config.output_rules[rule][1]
+
+        try:
+            with open(output_file, 'rb') as in_file:
+                body = in_file.read()
+        except EnvironmentError:
+            self.logger.error('Cannot read output from {0}'.format(output_file))
+            return None
+
+        content_type = mimetypes.guess_type(output_file)[0] or 'application/octet-stream'
+        document = RenderedDocument(digest, body, content_type)
+
+        with self._lock:
+            self._documents[rule] = document
+
+        return document
+
+    def refresh(self):
+        """
+        Re-renders, in the background, any rule whose inputs (e.g. the data store) have changed, every
+        config.serve_refresh_interval seconds, so that requests are answered from memory
+        :return: nothing
+        """
+        while not self._stopped.wait(self.config.serve_refresh_interval):
+            for rule in self.rules:
+                try:
+                    self.document(rule)
+                except Exception as exc:
+                    self.logger.error("Cannot refresh {0}: {1}".format(rule, exc))
+
+    def serve(self, host, port):
+        """
+        Serves the rules over HTTP until interrupted
+        :param host: the address to bind
+        :param port: the port to bind
+        :return: nothing
+        """
+        httpd = ThreadingHTTPServer((host, port), _handler(self))
+
+        for rule in self.rules:
+            self.document(rule)
+
+        refresher = threading.Thread(target=self.refresh, daemon=True)
+        refresher.start()
+
+        self.logger.info("Serving {0} on http://{1}:{2}/".format(', '.join(self.rules), host,
+                                                                httpd.server_address[1]))
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("Stopped serving")
+        finally:
+            self._stopped.set()
+            httpd.server_close()
+
+
+def _handler(service):
+    """
+    Builds a request handler class bound to a service
+    :param service: the CVService
+    :return: a BaseHTTPRequestHandler subclass
+    """
+    class CVRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            service.logger.debug("{0} - {1}".format(self.address_string(), format % args))
+
+        def do_HEAD(self):
+            self._respond(include_body=False)
+
+        def do_GET(self):
+            self._respond(include_body=True)
+
+        def _respond(self, include_body):
+            rule = self.path.split('?')[0].strip('/') or service.rules[0]
+
+            if rule not in service.rules:
+                self._send_status(404)
+                return
+
+            document = service.document(rule)
+
+            if document is None:
+                self._send_status(500)
+                return
+
+            if_none_match = self.headers.get('If-None-Match')
+
+            if if_none_match is not None and (if_none_match.strip() == '*' or
+                                              document.etag in [tag.strip() for tag in if_none_match.split(',')]):
+                self.send_response(304)
+                self.send_header('ETag', document.etag)
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', document.content_type)
+            self.send_header('Content-Length', str(len(document.body)))
+            self.send_header('ETag', document.etag)
+            # clients may keep a copy but must revalidate it, which is cheap thanks to the ETag
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+
+            if include_body:
+                self.wfile.write(document.body)
+
+        def _send_status(self, status):
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return CVRequestHandler
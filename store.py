@@ -0,0 +1,549 @@
+import gc
+import hashlib
+import json
+import marshal
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import zlib
+
+# the binary store's header: magic, format version, flags, schema version, the marshal format version and the
+# interpreter version that wrote the data, and the sha256 of the source export
+# every format version starts with the magic and format version, so that other versions can be recognised as stale
+BINARY_MAGIC = b'EPCV'
+BINARY_FORMAT = 2
+BINARY_PREFIX = struct.Struct('>4sB')
+BINARY_HEADER = struct.Struct('>4sBBHBBB32s')
+BINARY_COMPRESSED = 0x01
+
+# marshal's format is specific to the interpreter version, so a store is only read by the version that wrote it
+PYTHON_VERSION = '{0}.{1}'.format(sys.version_info[0], sys.version_info[1])
+
+# bump this when the layout of the stored data changes, so that older stores are rebuilt rather than misread
+SCHEMA_VERSION = 1
+
+
+def item_key(item):
+    """
+    The key under which an item is stored once, however many sections it appears in
+    :param item: an eprints item
+    :return: the eprint id, or a hash of the item if it has none
+    """
+    if 'eprintid' in item:
+        return str(item['eprintid'])
+
+    return hashlib.sha1(json.dumps(item, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class JsonlStore:
+    def __init__(self, config, logger):
+        """
+        Initialise a store that keeps a full copy of each item in a JSON-lines file per section (config.storage)
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.config = config
+        self.logger = logger
+
+    def signature(self, name):
+        """
+        Identifies the current on-disk version of a section
+        :param name: the name of the section
+        :return: a hashable signature that changes whenever the section does
+        :raises EnvironmentError: if the section cannot be found
+        """
+        stat = os.stat(self.config.storage[name])
+        return self.config.storage[name], stat.st_mtime_ns, stat.st_size
+
+    def has_sections(self, names):
+        """
+        Checks whether sections exist on disk
+        :param names: a list of section names
+        :return: True if all of the sections exist, otherwise False
+        """
+        return all(os.path.isfile(self.config.storage[name]) for name in names)
+
+    def read(self, name):
+        """
+        Reads a section
+        :param name: the name of the section
+        :return: a list of items
+        :raises EnvironmentError: if the section cannot be read
+        """
+        with open(self.config.storage[name], "r") as json_in_file:
+            return [json.loads(line) for line in json_in_file]
+
+    def writer(self):
+        """
+        Starts writing a new version of the sections
+        :return: a JsonlWriter
+        """
+        return JsonlWriter(self)
+
+
+class JsonlWriter:
+    def __init__(self, store):
+        """
+        Initialise a writer that replaces each written section's file once all items are written
+        :param store: the JsonlStore
+        """
+        self.store = store
+        self.sections = []
+        self._out_files = {}
+
+    def _path(self, name):
+        # sections are written alongside their destination so that the final rename is atomic
+        return self.store.config.storage[name] + '.part'
+
+    def add(self, item, item_types):
+        """
+        Adds an item to the end of a set of sections
+        :param item: the eprints item
+        :param item_types: the names of the sections
+        :return: nothing
+        """
+        line = json.dumps(item) + '\n'
+
+        for item_type in item_types:
+            self.open(item_type).write(line)
+
+    def open(self, name):
+        """
+        Starts writing a section, so that it is replaced on commit even if no items are added to it
+        :param name: the name of the section
+        :return: the temporary file for the section
+        """
+        if name not in self._out_files:
+            self.store.logger.debug("Writing {0} to {1}".format(name, self.store.config.storage[name]))
+            self._out_files[name] = open(self._path(name), "w")
+            self.sections.append(name)
+
+        return self._out_files[name]
+
+    def commit(self, source_hash=None):
+        """
+        Replaces the section files with the newly written ones (sections that received no items are left alone)
+        :param source_hash: the sha256 of the source export (not recorded by this format)
+        :return: nothing
+        """
+        for item_type, out_file in self._out_files.items():
+            out_file.close()
+            os.replace(self._path(item_type), self.store.config.storage[item_type])
+
+        self._out_files = {}
+
+    def abort(self):
+        """
+        Deletes the partially written files
+        :return: nothing
+        """
+        for item_type, out_file in self._out_files.items():
+            out_file.close()
+            if os.path.isfile(self._path(item_type)):
+                os.remove(self._path(item_type))
+
+        self._out_files = {}
+
+
+class SqliteStore:
+    def __init__(self, config, logger):
+        """
+        Initialise a store that keeps each item once, keyed by eprint id, with each section an ordered list of ids
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.config = config
+        self.logger = logger
+        self.path = config.storage['db']
+        # the signature of the database and its items decoded so far, keyed by id, so that an item in several sections
+        # is only decoded once
+        self._decoded = None
+        self._lock = threading.Lock()
+
+    def _connect(self, path):
+        # a connection per call keeps the store safe to use from the threads that build rules
+        if path == self.path:
+            return sqlite3.connect('file:{0}?mode=ro'.format(path), uri=True)
+
+        return sqlite3.connect(path)
+
+    def signature(self, name):
+        """
+        Identifies the current version of a section (any change to the database changes every section's signature)
+        :param name: the name of the section
+        :return: a hashable signature
+        :raises EnvironmentError: if the database cannot be found
+        """
+        stat = os.stat(self.path)
+        return self.path, stat.st_mtime_ns, stat.st_size
+
+    def has_sections(self, names):
+        """
+        Checks whether sections were recorded in the database
+        :param names: a list of section names
+        :return: True if all of the sections exist, otherwise False
+        """
+        if not os.path.isfile(self.path):
+            return False
+
+        connection = self._connect(self.path)
+        try:
+            stored = set(row[0] for row in connection.execute('SELECT name FROM section_names'))
+        except sqlite3.Error:
+            return False
+        finally:
+            connection.close()
+
+        return all(name in stored for name in names)
+
+    def read(self, name):
+        """
+        Reads a section, resolving its ids to items
+        :param name: the name of the section
+        :return: a list of items
+        :raises EnvironmentError: if the store cannot be read
+        """
+        if not os.path.isfile(self.path):
+            raise FileNotFoundError(self.path)
+
+        signature = self.signature(name)
+        connection = self._connect(self.path)
+        try:
+            rows = connection.execute('SELECT items.id, items.data FROM sections '
+                                      'JOIN items ON sections.item = items.id '
+                                      'WHERE sections.name = ? ORDER BY sections.position', (name,)).fetchall()
+        except sqlite3.Error as exc:
+            raise EnvironmentError('Cannot read {0} from {1}: {2}'.format(name, self.path, exc))
+        finally:
+            connection.close()
+
+        with self._lock:
+            if self._decoded is None or self._decoded[0] != signature:
+                self._decoded = (signature, {})
+
+            decoded = self._decoded[1]
+
+            for key, data in rows:
+                if key not in decoded:
+                    decoded[key] = json.loads(data)
+
+            return [decoded[key] for key, data in rows]
+
+    def writer(self):
+        """
+        Starts writing a new version of the database
+        :return: a SqliteWriter
+        """
+        return SqliteWriter(self)
+
+
+class SqliteWriter:
+    def __init__(self, store):
+        """
+        Initialise a writer that builds a new database and replaces the existing one when committed
+        :param store: the SqliteStore
+        """
+        self.store = store
+        self.sections = []
+        self._temp_path = store.path + '.part'
+        self._positions = {}
+
+        if os.path.isfile(self._temp_path):
+            os.remove(self._temp_path)
+
+        self._connection = store._connect(self._temp_path)
+        self._connection.executescript('''
+            CREATE TABLE items (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE sections (name TEXT NOT NULL, position INTEGER NOT NULL, item TEXT NOT NULL,
+                                   PRIMARY KEY (name, position));
+            CREATE TABLE section_names (name TEXT PRIMARY KEY);
+        ''')
+
+    def add(self, item, item_types):
+        """
+        Stores an item (once) and appends its id to a set of sections
+        :param item: the eprints item
+        :param item_types: the names of the sections
+        :return: nothing
+        """
+        key = item_key(item)
+
+        self._connection.execute('INSERT OR REPLACE INTO items (id, data) VALUES (?, ?)', (key, json.dumps(item)))
+
+        for item_type in item_types:
+            if item_type not in self._positions:
+                self.store.logger.debug("Writing {0} to {1}".format(item_type, self.store.path))
+                self._positions[item_type] = 0
+                self.sections.append(item_type)
+
+            self._connection.execute('INSERT INTO sections (name, position, item) VALUES (?, ?, ?)',
+                                     (item_type, self._positions[item_type], key))
+            self._positions[item_type] += 1
+
+    def commit(self, source_hash=None):
+        """
+        Replaces the database with the newly written one
+        :param source_hash: the sha256 of the source export (not recorded by this format)
+        :return: nothing
+        """
+        # every known section is recorded, so that a section with no items reads as empty rather than missing
+        self._connection.executemany('INSERT INTO section_names (name) VALUES (?)',
+                                     [(name,) for name in self.store.config.eprints_db])
+        self._connection.commit()
+        self._connection.close()
+
+        os.replace(self._temp_path, self.store.path)
+
+    def abort(self):
+        """
+        Deletes the partially written database
+        :return: nothing
+        """
+        self._connection.close()
+
+        if os.path.isfile(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class BinaryStore:
+    def __init__(self, config, logger):
+        """
+        Initialise a store that keeps every item once in a single marshalled (and optionally compressed) file,
+        which is decoded in one pass and held in memory for as long as the file is unchanged
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.config = config
+        self.logger = logger
+        self.path = config.storage['binary']
+        self._decoded = None
+        self._lock = threading.Lock()
+
+    def signature(self, name):
+        """
+        Identifies the current version of a section (any change to the file changes every section's signature)
+        :param name: the name of the section
+        :return: a hashable signature
+        :raises EnvironmentError: if the file cannot be found
+        """
+        stat = os.stat(self.path)
+        return self.path, stat.st_mtime_ns, stat.st_size
+
+    def header(self):
+        """
+        Reads the header of the file
+        :return: a dictionary of the format version, whether the data is compressed, the schema version, the marshal and
+        interpreter versions that wrote the data and the sha256 of the source export (only the format version for a
+        store written in another format)
+        :raises EnvironmentError: if the file cannot be read or is not a store
+        """
+        with open(self.path, 'rb') as in_file:
+            return self._parse_header(in_file.read(BINARY_HEADER.size))
+
+    def _parse_header(self, data):
+        if len(data) < BINARY_PREFIX.size:
+            raise EnvironmentError('{0} is truncated'.format(self.path))
+
+        magic, version = BINARY_PREFIX.unpack_from(data)
+
+        if magic != BINARY_MAGIC:
+            raise EnvironmentError('{0} is not a section store'.format(self.path))
+
+        # the rest of another format's header cannot be read
+        if version != BINARY_FORMAT:
+            return {'version': version}
+
+        if len(data) < BINARY_HEADER.size:
+            raise EnvironmentError('{0} is truncated'.format(self.path))
+
+        magic, version, flags, schema, marshal_version, major, minor, source_hash = BINARY_HEADER.unpack_from(data)
+
+        return {'version': version,
+                'compressed': bool(flags & BINARY_COMPRESSED),
+                'schema': schema,
+                'marshal': marshal_version,
+                'python': '{0}.{1}'.format(major, minor),
+                'source_hash': source_hash.hex()}
+
+    def _load(self):
+        """
+        Decodes the whole file, or returns the decoded data if the file has not changed since it was last read
+        :return: a dictionary with 'items' (ids to items) and 'sections' (names to lists of ids)
+        :raises EnvironmentError: if the file cannot be read, or was written by another format, schema, marshal or
+        interpreter version (and so must be rebuilt by a fetch)
+        """
+        signature = self.signature(None)
+
+        with self._lock:
+            if self._decoded is not None and self._decoded[0] == signature:
+                return self._decoded[1]
+
+            with open(self.path, 'rb') as in_file:
+                data = in_file.read()
+
+            header = self._parse_header(data)
+
+            expected = {'version': BINARY_FORMAT, 'schema': SCHEMA_VERSION, 'marshal': marshal.version,
+                        'python': PYTHON_VERSION}
+            stale = ['{0} {1} (expected {2})'.format(key, header[key], value) for key, value in expected.items()
+                     if key in header and header[key] != value]
+
+            if len(stale) > 0:
+                raise EnvironmentError('{0} is stale, with {1}: run a fetch to rebuild it'.format(
+                    self.path, ', '.join(stale)))
+
+            payload = memoryview(data)[BINARY_HEADER.size:]
+
+            # the decoded data has no reference cycles, so the collector's passes over the freshly allocated items
+            # are wasted work (roughly doubling the decode time on large stores)
+            collecting = gc.isenabled()
+            gc.disable()
+
+            try:
+                decoded = marshal.loads(zlib.decompress(payload) if header['compressed'] else payload)
+            except (ValueError, EOFError, TypeError, zlib.error) as exc:
+                raise EnvironmentError('Cannot decode {0}: {1}'.format(self.path, exc))
+            finally:
+                if collecting:
+                    gc.enable()
+
+            self._decoded = (signature, decoded)
+            return decoded
+
+    def has_sections(self, names):
+        """
+        Checks whether sections were recorded in a readable store
+        :param names: a list of section names
+        :return: True if all of the sections exist, otherwise False
+        """
+        try:
+            sections = self._load()['sections']
+        except EnvironmentError:
+            return False
+
+        return all(name in sections for name in names)
+
+    def read(self, name):
+        """
+        Reads a section, resolving its ids to items
+        :param name: the name of the section
+        :return: a list of items
+        :raises EnvironmentError: if the store cannot be read or does not contain the section
+        """
+        decoded = self._load()
+
+        if name not in decoded['sections']:
+            raise EnvironmentError('{0} does not contain {1}'.format(self.path, name))
+
+        items = decoded['items']
+        return [items[key] for key in decoded['sections'][name]]
+
+    def writer(self):
+        """
+        Starts writing a new version of the store
+        :return: a BinaryWriter
+        """
+        return BinaryWriter(self)
+
+
+class BinaryWriter:
+    def __init__(self, store):
+        """
+        Initialise a writer that collects items in memory and writes the store in one go when committed
+        :param store: the BinaryStore
+        """
+        self.store = store
+        self.sections = []
+        self._items = {}
+        # every known section is recorded, so that a section with no items reads as empty rather than missing
+        self._sections = {name: [] for name in store.config.eprints_db}
+
+    def add(self, item, item_types):
+        """
+        Stores an item (once) and appends its id to a set of sections
+        :param item: the eprints item
+        :param item_types: the names of the sections
+        :return: nothing
+        """
+        key = item_key(item)
+        self._items[key] = item
+
+        for item_type in item_types:
+            if item_type not in self.sections:
+                self.store.logger.debug("Writing {0} to {1}".format(item_type, self.store.path))
+                self.sections.append(item_type)
+
+            self._sections.setdefault(item_type, []).append(key)
+
+    def commit(self, source_hash=None):
+        """
+        Encodes the items and sections and replaces the store
+        :param source_hash: the sha256 of the source export, as a hex string, recorded in the header
+        :return: nothing
+        """
+        payload = marshal.dumps({'items': self._items, 'sections': self._sections})
+        flags = 0
+
+        if self.store.config.storage_compression > 0:
+            payload = zlib.compress(payload, self.store.config.storage_compression)
+            flags |= BINARY_COMPRESSED
+
+        header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_FORMAT, flags, SCHEMA_VERSION, marshal.version,
+                                    sys.version_info[0], sys.version_info[1],
+                                    bytes.fromhex(source_hash) if source_hash else bytes(32))
+
+        temp_path = self.store.path + '.part'
+
+        with open(temp_path, 'wb') as out_file:
+            out_file.write(header)
+            out_file.write(payload)
+
+        os.replace(temp_path, self.store.path)
+
+        self._items = {}
+        self._sections = {}
+
+    def abort(self):
+        """
+        Discards the collected items and any partially written file
+        :return: nothing
+        """
+        self._items = {}
+        self._sections = {}
+
+        if os.path.isfile(self.store.path + '.part'):
+            os.remove(self.store.path + '.part')
+
+
+def export_jsonl(store, config, logger, names):
+    """
+    Writes sections from a store to the JSON-lines files in config.storage
+    :param store: the store to read from
+    :param config: a configuration
+    :param logger: a logger
+    :param names: the names of the sections to export
+    :return: nothing
+    :raises EnvironmentError: if a section cannot be read or written
+    """
+    writer = JsonlStore(config, logger).writer()
+
+    try:
+        for name in names:
+            writer.open(name)
+
+            for item in store.read(name):
+                writer.add(item, [name])
+            logger.info("Exported {0} to {1}".format(name, config.storage[name]))
+
+        writer.commit()
+    except EnvironmentError:
+        writer.abort()
+        raise
+
+
+# the storage backends that can be selected in config.storage_backend
+STORES = {'jsonl': JsonlStore,
+          'sqlite': SqliteStore,
+          'binary': BinaryStore}
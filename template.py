@@ -0,0 +1,67 @@
+import os
+import re
+import threading
+
+PLACEHOLDER = re.compile('{{(.+?)}}')
+
+
+class CompiledTemplate:
+    def __init__(self, text):
+        """
+        Parse a template into literal segments and placeholder slots
+        :param text: the template string
+        """
+        # re.split with a capturing group alternates literals (even indexes) and placeholder names (odd indexes)
+        self.segments = PLACEHOLDER.split(text)
+
+    @property
+    def placeholders(self):
+        """
+        The placeholder names in the template, in order of first appearance
+        :return: a list of names
+        """
+        return list(dict.fromkeys(self.segments[1::2]))
+
+    def render(self, substitutes):
+        """
+        Assemble the document in a single pass. Substituted content is never re-scanned for placeholders.
+        :param substitutes: a dictionary of placeholder names to strings
+        :return: the rendered document
+        """
+        output = list(self.segments)
+        output[1::2] = [substitutes[name] for name in self.segments[1::2]]
+
+        return ''.join(output)
+
+
+class TemplateCache:
+    def __init__(self):
+        """
+        Initialise a cache of compiled templates keyed by path and invalidated when the file changes
+        """
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        Fetch the compiled form of a template, parsing it if it is new or has changed on disk
+        :param path: the template file
+        :return: a CompiledTemplate
+        :raises EnvironmentError: if the template cannot be read
+        """
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            if path in self._templates and self._templates[path][0] == signature:
+                return self._templates[path][1]
+
+        with open(path, 'r') as f:
+            content = [line.rstrip('\n') for line in f]
+
+        compiled = CompiledTemplate('\n'.join(content))
+
+        with self._lock:
+            self._templates[path] = (signature, compiled)
+
+        return compiled
@@ -0,0 +1,166 @@
+"""
+Checks that batched citeproc requests render exactly as the per-item requests do.
+
+Usage:
+  python3 -m unittest discover tests
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import config
+from citeproc import CiteProc
+from repository import Repository
+
+RULE = 'html'
+SECTION = 'book_chapters'
+
+
+def _names(names):
+    return '; '.join('{0}, {1}'.format(name['family'], name['given']) for name in names)
+
+
+class _SubstitutingHandler(BaseHTTPRequestHandler):
+    """
+    A stub citeproc-js-server that sorts a bibliography by its first name group and, like MHRA, replaces the names of
+    an entry with "---" when they repeat those of the entry before (an editor stands in for a missing author, and the
+    title for missing names)
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        entries = []
+
+        for item in payload['items'].values():
+            if 'author' in item:
+                group = _names(item['author'])
+            elif 'editor' in item:
+                group = _names(item['editor'])
+            else:
+                group = item['title']
+
+            entries.append((group, item['title'], item['id']))
+
+        entries.sort()
+        previous = None
+        output = []
+
+        for group, title, identifier in entries:
+            output.append('<div class="csl-entry">{0}. {1}.</div>'.format('---' if group == previous else group,
+                                                                            title))
+            previous = group
+
+        body = json.dumps({'bibliography': [{'entry_ids': [[entry[2]] for entry in entries]}, output]}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _item(eprintid, title, creators=None, editors=None):
+    item = {'eprintid': eprintid, 'type': 'book_section', 'title': title, 'date': '2020',
+            'uri': 'https://example.org/{0}'.format(eprintid)}
+
+    if creators is not None:
+        item['creators'] = [{'name': {'family': family, 'given': 'A.'}} for family in creators]
+    if editors is not None:
+        item['editors'] = [{'name': {'family': family, 'given': 'A.'}} for family in editors]
+
+    return item
+
+
+# pairs of items whose names (or titles) would be substituted if they were rendered in the same request
+ITEMS = [_item(1, 'Authored by Eve', creators=['Eve']),
+         _item(2, 'Edited by Eve', editors=['Eve']),
+         _item(3, 'Also authored by Eve', creators=['Eve']),
+         _item(4, 'An Anonymous Work'),
+         _item(5, 'An Anonymous Work'),
+         _item(6, 'Co-authored by Eve', creators=['Eve', 'Smith']),
+         _item(7, 'Authored by Smith', creators=['Smith']),
+         _item(8, 'Authored by Jones', creators=['Jones']),
+         _item(9, 'Edited by Brown', editors=['Brown']),
+         _item(10, 'Authored by Brown', creators=['Brown'])]
+
+
+class BatchingTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _SubstitutingHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.config = types.ModuleType('test_config')
+        self.config.__dict__.update({key: value for key, value in vars(config).items() if not key.startswith('__')})
+        self.config.storage_backend = 'jsonl'
+        self.config.storage = {key: os.path.join(self.directory, os.path.basename(path))
+                               for key, path in config.storage.items()}
+        self.config.citeproc_ports = [str(self.server.server_address[1])]
+        self.config.citeproc_cache_size = 0
+        self.config.incremental_builds = False
+        self.config.citeproc_engine = dict(config.citeproc_engine, **{RULE: 'http'})
+        self.config.citeproc_batch_style = dict(config.citeproc_batch_style, **{RULE: None})
+
+        self.logger = logging.getLogger('test')
+        self.repo = Repository(self.config, self.logger, False)
+        self.assertTrue(self.repo._write_sections_to_disk(iter(ITEMS)))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _render(self, batch_size):
+        self.config.citeproc_batch_size = dict(config.citeproc_batch_size, **{RULE: batch_size})
+        citeproc = CiteProc(self.repo, self.config, self.logger)
+
+        try:
+            return citeproc._eprint_substitute(SECTION, RULE)
+        finally:
+            citeproc.close()
+
+    def test_batched_output_matches_per_item_output(self):
+        expected = self._render(1)
+
+        self.assertIn('Edited by Eve', expected)
+        self.assertNotIn('---', expected)
+
+        for batch_size in [2, 3, len(ITEMS)]:
+            self.assertEqual(expected, self._render(batch_size))
+
+    def test_names_are_compared_whatever_their_field(self):
+        self.config.citeproc_batch_size = dict(config.citeproc_batch_size, **{RULE: len(ITEMS)})
+        citeproc = CiteProc(self.repo, self.config, self.logger)
+
+        outputs = []
+
+        for item in ITEMS[0:2]:
+            csl_item = {'id': str(item['eprintid']), 'title': item['title']}
+
+            if 'creators' in item:
+                csl_item['author'] = [name['name'] for name in item['creators']]
+            else:
+                csl_item['editor'] = [name['name'] for name in item['editors']]
+
+            outputs.append({'items': {csl_item['id']: csl_item}})
+
+        batches = citeproc._build_batches([0, 1], outputs, RULE)
+
+        self.assertEqual([[0], [1]], [batch for style, batch in batches])
+
+
+if __name__ == '__main__':
+    unittest.main()
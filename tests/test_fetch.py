@@ -0,0 +1,113 @@
+"""
+Checks how a refresh handles the responses of the eprints export: new data, unchanged data and errors.
+
+Usage:
+  python3 -m unittest discover tests
+"""
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import config
+from repository import Repository
+
+TYPES = ['all_books']
+ETAG = '"v1"'
+BODY = json.dumps([{'eprintid': 1, 'type': 'book', 'title': 'A Book', 'date': '2020',
+                    'uri': 'https://example.org/1', 'creators': [{'name': {'family': 'Eve', 'given': 'A.'}}]}])
+
+
+class _ExportHandler(BaseHTTPRequestHandler):
+    """
+    A stub eprints export that answers with the server's status, honouring If-None-Match when the status is 200
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+
+        if self.server.status == 200 and self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # an error page that happens to parse must not replace the data either
+        body = BODY.encode('utf-8') if self.server.status == 200 else b'[]'
+
+        self.send_response(self.server.status)
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FetchTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _ExportHandler)
+        self.server.status = 200
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.config = types.ModuleType('test_config')
+        self.config.__dict__.update({key: value for key, value in vars(config).items() if not key.startswith('__')})
+        self.config.storage_backend = 'jsonl'
+        self.config.storage = {key: os.path.join(self.directory, os.path.basename(path))
+                               for key, path in config.storage.items()}
+        self.config.eprints = {'repo': 'http://127.0.0.1:{0}'.format(self.server.server_address[1]), 'user': 'eve'}
+
+        self.logger = logging.getLogger('test')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def _fetch(self):
+        return Repository(self.config, self.logger, True).fetch(TYPES)
+
+    def _read(self, name):
+        with open(self.config.storage[name]) as data_file:
+            return data_file.read()
+
+    def test_new_data_is_stored_with_its_validators(self):
+        self.assertTrue(self._fetch())
+
+        self.assertEqual(BODY, self._read('json'))
+        self.assertEqual(ETAG, json.loads(self._read('json_validators'))['etag'])
+        self.assertEqual(['A Book'], [item['title'] for item in Repository(self.config, self.logger, False).all_books])
+
+    def test_unchanged_data_is_not_downloaded_again(self):
+        self.assertTrue(self._fetch())
+        self.assertTrue(self._fetch())
+
+        self.assertEqual([None, ETAG], self.server.requests)
+        self.assertEqual(BODY, self._read('json'))
+
+    def test_errors_leave_the_stored_data_alone(self):
+        self.assertTrue(self._fetch())
+
+        self.server.status = 500
+
+        self.assertFalse(self._fetch())
+
+        self.assertEqual(BODY, self._read('json'))
+        self.assertEqual(1, len(Repository(self.config, self.logger, False).all_books))
+        self.assertFalse(os.path.isfile(self.config.storage['json'] + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Checks that a deferred citeproc start which fails is retried by the next build, after stopping the old servers.
+
+Usage:
+  python3 -m unittest discover tests
+"""
+import json
+import logging
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import config
+from citeproc import CiteProc
+from repository import Repository
+
+RULE = 'html'
+SECTION = 'book_chapters'
+
+
+class _TitleHandler(BaseHTTPRequestHandler):
+    """
+    A stub citeproc-js-server that renders each entry as its title
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        items = list(payload['items'].values())
+        output = ['<div class="csl-entry">{0}.</div>'.format(item['title']) for item in items]
+
+        body = json.dumps({'bibliography': [{'entry_ids': [[item['id']] for item in items]}, output]}).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+class StartupTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.port = _free_port()
+        self.server = None
+
+        template = os.path.join(self.directory, 'template')
+        self.output = os.path.join(self.directory, 'cv.html')
+
+        with open(template, 'w') as template_file:
+            template_file.write('{{' + SECTION + '}}\n')
+
+        self.config = types.ModuleType('test_config')
+        self.config.__dict__.update({key: value for key, value in vars(config).items() if not key.startswith('__')})
+        self.config.storage_backend = 'jsonl'
+        self.config.storage = {key: os.path.join(self.directory, os.path.basename(path))
+                               for key, path in config.storage.items()}
+        self.config.output_rules = dict(config.output_rules, **{RULE: [template, self.output]})
+        self.config.citeproc_ports = [str(self.port)]
+        self.config.citeproc_ready_timeout = 0.5
+        self.config.citeproc_cache_size = 0
+        self.config.incremental_builds = False
+        self.config.citeproc_engine = dict(config.citeproc_engine, **{RULE: 'http'})
+
+        self.logger = logging.getLogger('test')
+        self.repo = Repository(self.config, self.logger, False)
+        self.assertTrue(self.repo._write_sections_to_disk(iter([
+            {'eprintid': 1, 'type': 'book_section', 'title': 'A Chapter', 'date': '2020',
+             'uri': 'https://example.org/1', 'creators': [{'name': {'family': 'Eve', 'given': 'A.'}}]}])))
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def test_failed_start_is_retried_by_the_next_build(self):
+        citeproc = CiteProc(self.repo, self.config, self.logger)
+
+        # the servers are "started" and "stopped" by recording the calls rather than running screen
+        calls = []
+        citeproc.init_commands = []
+        citeproc.shutdown_commands = []
+        start = citeproc.start
+        citeproc.start = lambda *args, **kwargs: calls.append('start') or start(*args, **kwargs)
+        citeproc._stop_servers = lambda: calls.append('stop')
+
+        try:
+            self.assertTrue(citeproc.start([RULE], lazy=True))
+
+            # nothing listens on the port, so the deferred start fails and the build with it
+            self.assertFalse(citeproc.build([RULE]))
+            self.assertEqual(['start', 'start'], calls)
+            self.assertFalse(os.path.isfile(self.output))
+
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), _TitleHandler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+            # the next build stops whatever the failed start left running, then starts again
+            self.assertTrue(citeproc.build([RULE]))
+            self.assertEqual(['start', 'start', 'stop', 'start'], calls)
+
+            with open(self.output) as output_file:
+                self.assertIn('A Chapter.', output_file.read())
+        finally:
+            citeproc.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+import os
+import time
+
+import requests
+
+
+class Watcher:
+    def __init__(self, citeproc, config, logger):
+        """
+        Initialise a watcher that rebuilds rules when their templates, sections or data change, keeping the citeproc
+        server(s) and in-memory caches warm between builds
+        :param citeproc: a CiteProc
+        :param config: a configuration
+        :param logger: a logger
+        """
+        self.citeproc = citeproc
+        self.config = config
+        self.logger = logger
+
+    def _data_paths(self):
+        # the build writes the manifest and the external section memo itself, and the validators only change along
+        # with the export
+        return set(os.path.normpath(path) for name, path in self.config.storage.items()
+                   if name not in ('manifest', 'externals', 'json_validators'))
+
+    def scan(self):
+        """
+        Takes a snapshot of the watched files
+        :return: a dictionary of paths to (mtime, size) signatures
+        """
+        snapshot = {}
+
+        for directory in self.config.watch_directories:
+            try:
+                entries = list(os.scandir(directory))
+            except EnvironmentError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        snapshot[os.path.normpath(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+                except EnvironmentError:
+                    pass
+
+        for path in self._data_paths():
+            try:
+                stat = os.stat(path)
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+            except EnvironmentError:
+                pass
+
+        return snapshot
+
+    @staticmethod
+    def changes(before, after):
+        """
+        Compares two snapshots
+        :param before: the earlier snapshot
+        :param after: the later snapshot
+        :return: a set of the paths that were added, removed or modified
+        """
+        return set(path for path in set(before) | set(after) if before.get(path) != after.get(path))
+
+    def affected_rules(self, rules, paths):
+        """
+        Works out which rules depend on a set of changed files
+        :param rules: the rules being watched
+        :param paths: the changed paths
+        :return: a list of rule names
+        """
+        data_paths = self._data_paths()
+        affected = []
+
+        for rule in rules:
+            template_file = os.path.normpath(self.config.output_rules[rule][0])
+            template = self.citeproc._load_template(template_file)
+
+            for path in paths:
+                if path == template_file or template is None:
+                    affected.append(rule)
+                    break
+
+                if path in data_paths:
+                    if any(match in self.config.section_headings[rule] for match in template.placeholders):
+                        affected.append(rule)
+                        break
+                elif os.path.basename(path) in template.placeholders:
+                    affected.append(rule)
+                    break
+
+        return affected
+
+    def _build(self, rules):
+        """
+        Builds rules, logging rather than raising any error so that watching carries on (and retries the build on the
+        next change)
+        :param rules: a list of rule names
+        :return: True if all rules were built, otherwise False
+        """
+        try:
+            return self.citeproc.build(rules)
+        except (EnvironmentError, ValueError, requests.RequestException) as exc:
+            self.logger.error("Cannot build {0}: {1}".format(', '.join(rules), exc))
+            return False
+
+    def run(self, rules):
+        """
+        Builds the rules, then rebuilds the affected ones whenever files change, until interrupted
+        A burst of changes is collected until there have been none for config.watch_debounce seconds
+        :param rules: a list of rule names
+        :return: nothing
+        """
+        self._build(rules)
+        snapshot = self.scan()
+
+        self.logger.info("Watching {0} for changes to {1}".format(', '.join(self.config.watch_directories),
+                                                                  ', '.join(rules)))
+
+        try:
+            while True:
+                time.sleep(self.config.watch_interval)
+
+                current = self.scan()
+                changed = self.changes(snapshot, current)
+
+                if len(changed) == 0:
+                    continue
+
+                # wait for the edits to settle
+                last_change = time.monotonic()
+
+                while time.monotonic() - last_change < self.config.watch_debounce:
+                    time.sleep(self.config.watch_interval)
+                    latest = self.scan()
+
+                    if latest != current:
+                        changed |= self.changes(current, latest)
+                        current = latest
+                        last_change = time.monotonic()
+
+                snapshot = current
+
+                affected = self.affected_rules(rules, changed)
+                self.logger.debug("Changed: {0}".format(', '.join(sorted(changed))))
+
+                if len(affected) == 0:
+                    continue
+
+                self.logger.info("Rebuilding {0}".format(', '.join(affected)))
+                started = time.monotonic()
+
+                if self._build(affected):
+                    self.logger.info("Rebuilt {0} in {1:.2f}s".format(', '.join(affected),
+                                                                      time.monotonic() - started))
+                else:
+                    self.logger.error("Failed to rebuild {0}".format(', '.join(affected)))
+        except KeyboardInterrupt:
+            self.logger.info("Stopped watching")